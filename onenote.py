@@ -1,41 +1,1082 @@
 #!/usr/bin/env python3
 
-import requests
 import json
-import pyperclip
+import base64
+import binascii
+import hashlib
+import zlib
 import atexit
 import os
+import io
+import re
+import sys
+import tempfile
+import mimetypes
+import stat
+import signal
+import shlex
+import socket
+import socketserver
 import shelve
+import dbm
+import sqlite3
 import logging
 import time
+import random
 import datetime
+import difflib
 import argparse
-from bs4 import BeautifulSoup
-from msal import PublicClientApplication, SerializableTokenCache
-from dateutil import parser
+import threading
+from collections import deque
+from collections.abc import Mapping
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+import concurrent.futures
+import importlib.util
+
+
+def lazy_import(name):
+    '''Returns module, which is loaded on first use of its attribute, so
+    offline queries do not pay for importing modules used by download
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+requests = lazy_import('requests')
+pyperclip = lazy_import('pyperclip')
+msal = lazy_import('msal')
+bs4 = lazy_import('bs4')
+parser = lazy_import('dateutil.parser')
+statistics = lazy_import('statistics')
+
+
+class PageStore:
+    '''Keeps downloaded notebook in SQLite database with one row per page,
+    with full text index of page text and trigram index of titles
+    '''
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sections (
+            name TEXT PRIMARY KEY,
+            section_id TEXT,
+            modified TEXT,
+            position INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS pages (
+            section TEXT NOT NULL,
+            title TEXT NOT NULL,
+            page_id TEXT NOT NULL,
+            modified TEXT,
+            html TEXT,
+            position INTEGER,
+            text TEXT,
+            content_hash TEXT,
+            PRIMARY KEY (section, page_id)
+        );
+        CREATE TABLE IF NOT EXISTS contents (
+            hash TEXT PRIMARY KEY,
+            data BLOB,
+            text BLOB
+        );
+        CREATE INDEX IF NOT EXISTS pages_titles ON pages (section, position, title);
+        CREATE INDEX IF NOT EXISTS pages_section_titles ON pages (section, title);
+        CREATE VIEW IF NOT EXISTS page_texts AS
+            SELECT pages.rowid AS rowid, coalesce(pages.text, decompress(contents.text)) AS text FROM pages
+            LEFT JOIN contents ON contents.hash = pages.content_hash;
+        CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5 (text, content=page_texts, content_rowid=rowid);
+        CREATE TABLE IF NOT EXISTS checkpoint_sections (
+            name TEXT PRIMARY KEY,
+            section_id TEXT,
+            modified TEXT
+        );
+        CREATE TABLE IF NOT EXISTS checkpoint_pages (
+            section TEXT NOT NULL,
+            page_id TEXT NOT NULL,
+            modified TEXT,
+            PRIMARY KEY (section, page_id)
+        );
+        CREATE TABLE IF NOT EXISTS resources (
+            resource_id TEXT PRIMARY KEY,
+            path TEXT
+        );
+    '''
+    FUZZY_TRIGRAMS = 3
+    FUZZY_CANDIDATES = 100
+    TITLES_INDEX_SCHEMA = '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS titles_fts USING fts5 (
+            title, content=pages, content_rowid=rowid, tokenize='trigram'
+        )
+    '''
+
+    def __init__(self, path='notes.db', shelve_path='shelve.lib', compression_level=6):
+        is_new = path == ':memory:' or not os.path.exists(path)
+        self.path = path
+        self.compression_level = compression_level
+        self.connection = sqlite3.connect(path)
+        self.connection.create_function('decompress', 1, self._decompress_data, deterministic=True)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        has_titles_index = bool(
+            self.connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'titles_fts'").fetchone()
+        )
+        self.connection.executescript(self.SCHEMA)
+        try:
+            self.connection.execute(self.TITLES_INDEX_SCHEMA)
+            self.connection.execute('SELECT rowid FROM titles_fts LIMIT 1').fetchall()
+            self.indexes = ('pages_fts', 'titles_fts')
+        except sqlite3.OperationalError as e:
+            if 'tokenizer' not in str(e):
+                raise
+            self.indexes = ('pages_fts',)
+            has_titles_index = True
+        if is_new and shelve_path and dbm.whichdb(shelve_path):
+            sync_state_path = os.path.join(os.path.dirname(shelve_path), 'sync_state.lib')
+            self.import_shelve(shelve_path, sync_state_path)
+        elif not has_titles_index:
+            self.rebuild_index()
+
+    def import_shelve(self, shelve_path='shelve.lib', sync_state_path='sync_state.lib'):
+        '''Imports notebook saved in shelve file by older versions'''
+        print(f'Importing {shelve_path} to page store...')
+        sync_state = {}
+        if dbm.whichdb(sync_state_path):
+            with shelve.open(sync_state_path, 'r') as sync_state_lib:
+                sync_state = dict(sync_state_lib)
+
+        with shelve.open(shelve_path, 'r') as lib, self.connection, \
+                concurrent.futures.ProcessPoolExecutor() as executor:
+            for section_position, (section_name, section_notes) in enumerate(lib.items()):
+                section_state = sync_state.get(section_name, {})
+                pages_state = section_state.get('pages', {})
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO sections VALUES (?, ?, ?, ?)',
+                    (section_name, section_state.get('id'), section_state.get('lastModifiedDateTime'), section_position)
+                )
+                texts = executor.map(extract_text, section_notes.values(), chunksize=16)
+                for position, ((title, html), text) in enumerate(zip(section_notes.items(), texts)):
+                    page_state = pages_state.get(title, {})
+                    page_id = page_state.get('id') or f'shelve:{title}'
+                    html, text, content_hash = self._put_content(html, text)
+                    self.connection.execute(
+                        '''INSERT OR REPLACE INTO pages
+                           (section, title, page_id, modified, html, position, text, content_hash)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                        (
+                            section_name, title, page_id, page_state.get('lastModifiedDateTime'),
+                            html, position, text, content_hash
+                        )
+                    )
+        self.rebuild_index()
+
+    def rebuild_index(self):
+        '''Builds full text index and title index of all pages from scratch'''
+        with self.connection:
+            for index in self.indexes:
+                self.connection.execute(f"INSERT INTO {index} ({index}) VALUES ('rebuild')")
+
+    def compress_pages(self, batch_size=200):
+        '''Moves uncompressed pages (saved with compression_level None) to
+        contents table, vacuums database and rebuilds indexes (vacuum can
+        change rowids). Returns True if pages were compressed.
+        '''
+        if self.compression_level is None:
+            return False
+        rowids = [rowid for rowid, in self.connection.execute('SELECT rowid FROM pages WHERE content_hash IS NULL')]
+        if not rowids:
+            return False
+        print('Compressing pages in page store...')
+        for start in range(0, len(rowids), batch_size):
+            batch = rowids[start:start + batch_size]
+            rows = self.connection.execute(
+                f'SELECT rowid, html, text FROM pages WHERE rowid IN ({", ".join("?" * len(batch))})', batch
+            ).fetchall()
+            with self.connection:
+                for rowid, html, text in rows:
+                    self.connection.execute(
+                        'UPDATE pages SET html = ?, text = ?, content_hash = ? WHERE rowid = ?',
+                        (*self._put_content(html, text), rowid)
+                    )
+        self.connection.execute('VACUUM')
+        self.rebuild_index()
+        return True
+
+    def _put_content(self, html, text):
+        '''Saves compressed html and text to contents table, if the same
+        content is not saved already. Returns values of (html, text,
+        content_hash) columns of pages.
+        '''
+        if self.compression_level is None or html is None:
+            return html, text, None
+        data = html.encode()
+        content_hash = hashlib.sha256(data).hexdigest()
+        if not self.connection.execute('SELECT 1 FROM contents WHERE hash = ?', (content_hash,)).fetchone():
+            self.connection.execute(
+                'INSERT INTO contents VALUES (?, ?, ?)', (
+                    content_hash,
+                    zlib.compress(data, self.compression_level),
+                    zlib.compress(text.encode(), self.compression_level)
+                )
+            )
+        return None, None, content_hash
+
+    @staticmethod
+    def _decompress(value, data):
+        return value if data is None else zlib.decompress(data).decode()
+
+    @staticmethod
+    def _decompress_data(data):
+        return None if data is None else zlib.decompress(data).decode()
+
+    def get_resource_paths(self):
+        '''Returns dict with mapping: {resource id: path of cached resource}'''
+        return dict(self.connection.execute('SELECT resource_id, path FROM resources'))
+
+    def put_resources(self, resource_paths):
+        '''Saves {resource id: path} of downloaded resources'''
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO resources VALUES (?, ?)', resource_paths.items())
+
+    def remove_unused_contents(self):
+        '''Removes contents, which no page refers to (after pages were
+        updated or removed), returns number of removed contents
+        '''
+        with self.connection:
+            return self.connection.execute(
+                'DELETE FROM contents WHERE hash NOT IN (SELECT content_hash FROM pages WHERE content_hash IS NOT NULL)'
+            ).rowcount
+
+    def put_page(self, section_name, title, page_id, modified, html, position, text=None, checkpoint=False):
+        '''Saves page (identified by section and page id, titles are not
+        unique) with its text and indexes the text and title (rowid of
+        page is kept on update, it links page with its rows in pages_fts and
+        titles_fts, page is removed from indexes before update). Text is
+        extracted from html, if it is not provided. With checkpoint page is
+        also recorded in journal of current download in the same transaction.
+        '''
+        if text is None:
+            text = extract_text(html)
+        with self.connection:
+            self._remove_from_indexes('section = ? AND page_id = ?', [(section_name, page_id)])
+            html, stored_text, content_hash = self._put_content(html, text)
+            self.connection.execute(
+                '''INSERT INTO pages (section, title, page_id, modified, html, position, text, content_hash)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (section, page_id) DO UPDATE SET
+                   title = excluded.title, modified = excluded.modified,
+                   html = excluded.html, position = excluded.position, text = excluded.text,
+                   content_hash = excluded.content_hash''',
+                (section_name, title, page_id, modified, html, position, stored_text, content_hash)
+            )
+            rowid, = self.connection.execute(
+                'SELECT rowid FROM pages WHERE section = ? AND page_id = ?', (section_name, page_id)
+            ).fetchone()
+            self.connection.execute('INSERT INTO pages_fts (rowid, text) VALUES (?, ?)', (rowid, text))
+            if 'titles_fts' in self.indexes:
+                self.connection.execute('INSERT INTO titles_fts (rowid, title) VALUES (?, ?)', (rowid, title))
+            if checkpoint:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO checkpoint_pages VALUES (?, ?, ?)', (section_name, page_id, modified)
+                )
+
+    def put_section(self, section_name, section_id, modified, position, page_ids, checkpoint=False):
+        '''Marks section as downloaded: saves its modification time, page
+        order and removes its pages, which are not in page_ids anymore. With
+        checkpoint section is also recorded in journal of current download.
+        '''
+        stored_page_ids = set(self.get_page_states(section_name))
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO sections VALUES (?, ?, ?, ?)',
+                (section_name, section_id, modified, position)
+            )
+            removed_pages = [(section_name, page_id) for page_id in stored_page_ids - set(page_ids)]
+            self._remove_from_indexes('section = ? AND page_id = ?', removed_pages)
+            self.connection.executemany('DELETE FROM pages WHERE section = ? AND page_id = ?', removed_pages)
+            self.connection.executemany(
+                'UPDATE pages SET position = ? WHERE section = ? AND page_id = ?',
+                [(page_position, section_name, page_id) for page_position, page_id in enumerate(page_ids)]
+            )
+            if checkpoint:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO checkpoint_sections VALUES (?, ?, ?)', (section_name, section_id, modified)
+                )
+
+    def remove_sections_except(self, section_names):
+        '''Removes sections (with pages), which are not in section_names'''
+        stored_names = {
+            name for name, in self.connection.execute('SELECT name FROM sections UNION SELECT section FROM pages')
+        }
+        removed_names = sorted(stored_names - set(section_names))
+        with self.connection:
+            self.connection.executemany('DELETE FROM sections WHERE name = ?', [(name,) for name in removed_names])
+            self._remove_from_indexes('section = ?', [(name,) for name in removed_names])
+            self.connection.executemany('DELETE FROM pages WHERE section = ?', [(name,) for name in removed_names])
+        return removed_names
+
+    def _remove_from_indexes(self, condition, parameters):
+        '''Removes pages matching condition from pages_fts and titles_fts,
+        indexes read removed values from pages, so it is done before pages
+        are updated or deleted
+        '''
+        for index in self.indexes:
+            self.connection.executemany(
+                f'DELETE FROM {index} WHERE rowid IN (SELECT rowid FROM pages WHERE {condition})', parameters
+            )
+
+    def has_checkpoint(self):
+        '''Returns True if previous download was interrupted'''
+        return bool(
+            self.connection.execute('SELECT 1 FROM checkpoint_sections UNION ALL SELECT 1 FROM checkpoint_pages')
+            .fetchone()
+        )
+
+    def get_checkpoint_section(self, section_name):
+        '''Returns (section id, modified) of section completed by interrupted download or None'''
+        return self.connection.execute(
+            'SELECT section_id, modified FROM checkpoint_sections WHERE name = ?', (section_name,)
+        ).fetchone()
+
+    def get_checkpoint_pages(self, section_name):
+        '''Returns dict with mapping: {page id: modified} of pages saved by
+        interrupted download
+        '''
+        return dict(
+            self.connection.execute('SELECT page_id, modified FROM checkpoint_pages WHERE section = ?', (section_name,))
+        )
+
+    def clear_checkpoint(self):
+        '''Clears journal, when download is finished'''
+        with self.connection:
+            self.connection.execute('DELETE FROM checkpoint_sections')
+            self.connection.execute('DELETE FROM checkpoint_pages')
+
+    def get_section_state(self, section_name):
+        '''Returns (section id, modified) of downloaded section or None'''
+        return self.connection.execute(
+            'SELECT section_id, modified FROM sections WHERE name = ?', (section_name,)
+        ).fetchone()
+
+    def get_page_states(self, section_name):
+        '''Returns dict with mapping: {page id: modified}'''
+        return dict(self.connection.execute('SELECT page_id, modified FROM pages WHERE section = ?', (section_name,)))
+
+    def notes(self):
+        '''Returns lazy view with mapping: {section name: {page title: page html}}'''
+        return NotesView(self)
+
+    def iter_page_versions(self):
+        '''Yields (section name, page title, page id, version) of all pages
+        in notebook order without reading page contents, version changes
+        when page is saved with other content or modification time
+        '''
+        rows = self.connection.execute(
+            '''SELECT pages.section, pages.title, pages.page_id, pages.modified, pages.content_hash FROM pages
+               LEFT JOIN sections ON sections.name = pages.section
+               ORDER BY sections.position IS NULL, sections.position, pages.section, pages.position'''
+        )
+        for section_name, title, page_id, modified, content_hash in rows:
+            yield section_name, title, page_id, f'{page_id}|{modified}|{content_hash}'
+
+    def section_names(self):
+        '''Returns section names in notebook order, without reading pages'''
+        rows = self.connection.execute(
+            '''SELECT DISTINCT pages.section FROM pages
+               LEFT JOIN sections ON sections.name = pages.section
+               ORDER BY sections.position IS NULL, sections.position, pages.section'''
+        )
+        return [section_name for section_name, in rows]
+
+    def titles(self, section_name):
+        '''Returns page titles of section in notebook order (titles of
+        different pages can be the same), it is answered from pages_titles
+        index without reading page contents
+        '''
+        rows = self.connection.execute(
+            'SELECT title FROM pages WHERE section = ? ORDER BY position', (section_name,)
+        )
+        return [title for title, in rows]
+
+    def get_html(self, section_name, title, page_id=None):
+        '''Returns page html, decompressed if it is kept in contents table.
+        Page is found by page_id if it is given, else the first page with
+        title is returned.
+        '''
+        row = self.connection.execute(
+            f'''SELECT pages.html, contents.data FROM pages
+                LEFT JOIN contents ON contents.hash = pages.content_hash
+                WHERE {self._page_condition(page_id)}''',
+            (section_name, page_id or title)
+        ).fetchone()
+        if row is None:
+            raise KeyError(title)
+        return self._decompress(*row)
+
+    def get_text(self, section_name, title, page_id=None):
+        '''Returns text extracted from page html when it was downloaded,
+        page is found like in get_html
+        '''
+        row = self.connection.execute(
+            f'''SELECT pages.text, contents.text FROM pages
+                LEFT JOIN contents ON contents.hash = pages.content_hash
+                WHERE {self._page_condition(page_id)}''',
+            (section_name, page_id or title)
+        ).fetchone()
+        if row is None:
+            raise KeyError(title)
+        return self._decompress(*row)
+
+    def get_texts(self, section_name, title):
+        '''Returns texts of all pages with title in notebook order'''
+        rows = self.connection.execute(
+            '''SELECT pages.text, contents.text FROM pages
+               LEFT JOIN contents ON contents.hash = pages.content_hash
+               WHERE pages.section = ? AND pages.title = ? ORDER BY pages.position''',
+            (section_name, title)
+        )
+        return [self._decompress(*row) for row in rows]
+
+    @staticmethod
+    def _page_condition(page_id):
+        if page_id is None:
+            return 'pages.section = ? AND pages.title = ? ORDER BY pages.position LIMIT 1'
+        return 'pages.section = ? AND pages.page_id = ?'
+
+    def search(self, query):
+        '''Returns list of (section name, page title, snippet) of pages, which
+        text matches FTS5 query: all terms, "phrase" or prefix* by default.
+        Query which is not valid FTS5 syntax is searched as plain terms.
+        '''
+        try:
+            return self._search(query)
+        except sqlite3.OperationalError:
+            terms = ['"{}"'.format(term.replace('"', '""')) for term in query.split()]
+            return self._search(' '.join(terms)) if terms else []
+
+    def _search(self, query):
+        rows = self.connection.execute(
+            '''SELECT pages.section, pages.title, snippet(pages_fts, 0, '[', ']', '...', 12)
+               FROM pages_fts
+               JOIN pages ON pages.rowid = pages_fts.rowid
+               LEFT JOIN sections ON sections.name = pages.section
+               WHERE pages_fts MATCH ?
+               ORDER BY sections.position IS NULL, sections.position, pages.section, pages_fts.rank''',
+            (query,)
+        )
+        return [(section_name, title, ' '.join(snippet.split())) for section_name, title, snippet in rows]
+
+    def data_version(self):
+        '''Returns number, which changes when other connection (like
+        download) commits changes to the store
+        '''
+        return self.connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def find_titles(self, keyword, section_name=None):
+        '''Returns list of (section name, title) of pages (of section_name
+        only, if it is given), which titles contain keyword ignoring case,
+        exact titles first, or titles similar to keyword, most similar first
+        '''
+        folded = keyword.casefold()
+        has_titles_index = 'titles_fts' in self.indexes
+        if len(folded) < 3 or not has_titles_index:
+            # LIKE ignores case of ASCII only, titles with other characters (longer in UTF-8) are checked after
+            pattern = '%{}%'.format(re.sub(r'([%_\\])', r'\\\1', folded))
+            rows = self._find_title_rows(
+                "(pages.title LIKE ? ESCAPE '\\' OR length(pages.title) != length(CAST(pages.title AS BLOB)))",
+                (pattern,), section_name
+            )
+        else:
+            starts = sorted({0, (len(folded) - 3) // 2, len(folded) - 3})
+            query = ' AND '.join(self._quote(folded[start:start + 3]) for start in starts)
+            rows = self._find_title_rows('titles_fts MATCH ?', (query,), section_name)
+        found = [
+            (self._rank_match(folded, title), section_position, position, section, title)
+            for section, title, position, section_position in rows
+            if folded in title.casefold()
+        ]
+        if not found and len(folded) >= 3:
+            if has_titles_index:
+                trigrams = self._rarest_trigrams(folded)
+                rows = self._find_title_rows(
+                    'titles_fts MATCH ?',
+                    (' OR '.join(self._quote(trigram) for trigram in trigrams),),
+                    section_name,
+                    f'LIMIT {self.FUZZY_CANDIDATES}'
+                ) if trigrams else []
+            else:
+                rows = self._find_title_rows('1', (), section_name)
+            found = [
+                (-similarity, section_position, position, section, title)
+                for section, title, position, section_position in rows
+                for similarity in [self._similarity(folded, title.casefold())]
+                if similarity >= 0.8
+            ]
+        found.sort(key=lambda match: (match[0], match[1] is None, match[1] or 0, match[3], match[2]))
+        return [(section, title) for _, _, _, section, title in found]
+
+    def _rarest_trigrams(self, folded_keyword):
+        '''Returns up to FUZZY_TRIGRAMS trigrams of keyword found in the
+        fewest titles, the rarest one and then others while they are found
+        in at most FUZZY_CANDIDATES titles together
+        '''
+        counts = []
+        for trigram in {folded_keyword[start:start + 3] for start in range(len(folded_keyword) - 2)}:
+            count, = self.connection.execute(
+                'SELECT count(*) FROM (SELECT rowid FROM titles_fts WHERE titles_fts MATCH ? LIMIT ?)',
+                (self._quote(trigram), self.FUZZY_CANDIDATES)
+            ).fetchone()
+            if count:
+                counts.append((count, trigram))
+        trigrams = []
+        total = 0
+        for count, trigram in sorted(counts)[:self.FUZZY_TRIGRAMS]:
+            total += count
+            if trigrams and total > self.FUZZY_CANDIDATES:
+                break
+            trigrams.append(trigram)
+        return trigrams
+
+    def _find_title_rows(self, condition, parameters, section_name=None, order=''):
+        if section_name is not None:
+            condition += ' AND pages.section = ?'
+            parameters += (section_name,)
+        if condition.startswith('titles_fts'):
+            source = 'titles_fts JOIN pages ON pages.rowid = titles_fts.rowid'
+        else:
+            source = 'pages'
+        return self.connection.execute(
+            f'''SELECT pages.section, pages.title, pages.position, sections.position
+                FROM {source}
+                LEFT JOIN sections ON sections.name = pages.section
+                WHERE {condition} {order}''',
+            parameters
+        ).fetchall()
+
+    def find_sections(self, keyword):
+        '''Returns section names containing keyword ignoring case, ranked
+        like in find_titles, or section names similar to keyword. Notebook
+        has few sections, so they are matched without index.
+        '''
+        folded = keyword.casefold()
+        section_names = self.section_names()
+        found = [
+            (self._rank_match(folded, section_name), position, section_name)
+            for position, section_name in enumerate(section_names)
+            if folded in section_name.casefold()
+        ]
+        if not found:
+            found = [
+                (-similarity, position, section_name)
+                for position, section_name in enumerate(section_names)
+                for similarity in [self._similarity(folded, section_name.casefold())]
+                if similarity >= 0.8
+            ]
+        return [section_name for _, _, section_name in sorted(found)]
+
+    @staticmethod
+    def _quote(term):
+        return '"{}"'.format(term.replace('"', '""'))
+
+    @staticmethod
+    def _rank_match(folded_keyword, name):
+        '''Returns 0 for exact match, 1 for prefix match and 2 for other'''
+        folded_name = name.casefold()
+        if folded_name == folded_keyword:
+            return 0
+        return 1 if folded_name.startswith(folded_keyword) else 2
+
+    @staticmethod
+    def _similarity(folded_keyword, folded_name):
+        '''Returns similarity (0-1) of keyword to the most similar run of as
+        many words in name, so typo in one word of long title still matches
+        '''
+        words = folded_name.split()
+        length = max(len(folded_keyword.split()), 1)
+        runs = [' '.join(words[start:start + length]) for start in range(max(len(words) - length + 1, 1))]
+        return max(difflib.SequenceMatcher(None, folded_keyword, run).ratio() for run in runs)
+
+
+class NotesView(Mapping):
+    '''Read only {section name: {page title: page html}} view of PageStore.
+    Section names and titles are read on first use, page html is read
+    only when a specific page is accessed
+    '''
+    def __init__(self, store):
+        self.store = store
+        self._sections = None
+
+    def _get_sections(self):
+        if self._sections is None:
+            self._sections = {
+                section_name: SectionView(self.store, section_name)
+                for section_name in self.store.section_names()
+            }
+        return self._sections
+
+    def __getitem__(self, section_name):
+        return self._get_sections()[section_name]
+
+    def __iter__(self):
+        return iter(self._get_sections())
+
+    def __len__(self):
+        return len(self._get_sections())
+
+
+class SectionView(Mapping):
+    '''Read only {page title: page html} view of one section'''
+    def __init__(self, store, section_name):
+        self.store = store
+        self.section_name = section_name
+        self._titles = None
+
+    def _get_titles(self):
+        if self._titles is None:
+            self._titles = list(dict.fromkeys(self.store.titles(self.section_name)))
+        return self._titles
+
+    def __getitem__(self, title):
+        return self.store.get_html(self.section_name, title)
+
+    def __contains__(self, title):
+        return title in self._get_titles()
+
+    def __iter__(self):
+        return iter(self._get_titles())
+
+    def __len__(self):
+        return len(self._get_titles())
+
+
+class Metrics:
+    '''Collects durations of named phases (like page listing or store
+    write) with count, total, maximum and latency histogram of each. It
+    is shared by threads, so updates are locked.
+    '''
+    HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        '''Measures duration of with block as one occurrence of phase'''
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started_at)
+
+    def record(self, name, seconds):
+        with self.lock:
+            phase = self.phases.setdefault(name, {'count': 0, 'total': 0, 'max': 0, 'histogram': {}})
+            phase['count'] += 1
+            phase['total'] += seconds
+            phase['max'] = max(phase['max'], seconds)
+            bucket = self.bucket(seconds)
+            phase['histogram'][bucket] = phase['histogram'].get(bucket, 0) + 1
+
+    @classmethod
+    def bucket(cls, seconds):
+        '''Returns label of histogram bucket of duration, like '<=20' ms'''
+        milliseconds = seconds * 1000
+        for bound in cls.HISTOGRAM_BOUNDS_MS:
+            if milliseconds <= bound:
+                return f'<={bound}'
+        return f'>{cls.HISTOGRAM_BOUNDS_MS[-1]}'
+
+    @classmethod
+    def histogram(cls, durations):
+        '''Returns {bucket label: count} of durations in seconds, in order of buckets'''
+        counts = {}
+        for seconds in durations:
+            bucket = cls.bucket(seconds)
+            counts[bucket] = counts.get(bucket, 0) + 1
+        return cls._sort_histogram(counts)
+
+    @classmethod
+    def _sort_histogram(cls, counts):
+        labels = [f'<={bound}' for bound in cls.HISTOGRAM_BOUNDS_MS] + [f'>{cls.HISTOGRAM_BOUNDS_MS[-1]}']
+        return {label: counts[label] for label in labels if label in counts}
+
+    def summary(self):
+        '''Returns JSON serializable summary, durations in milliseconds'''
+        with self.lock:
+            return {
+                'wall_seconds': round(time.monotonic() - self.started_at, 3),
+                'phases': {
+                    name: {
+                        'count': phase['count'],
+                        'total_ms': round(phase['total'] * 1000, 1),
+                        'mean_ms': round(phase['total'] * 1000 / phase['count'], 3),
+                        'max_ms': round(phase['max'] * 1000, 3),
+                        'histogram_ms': self._sort_histogram(phase['histogram']),
+                    }
+                    for name, phase in self.phases.items()
+                },
+            }
+
+
+def write_stats(stats, path):
+    '''Writes stats as JSON to file path, or prints them for path '-' '''
+    if path == '-':
+        print(json.dumps(stats, indent=2))
+    else:
+        with open(path, 'w') as f:
+            json.dump(stats, f, indent=2)
+
+
+class TokenBucket:
+    '''Paces requests to rate per second. When Graph throttles, rate is
+    halved and requests wait for Retry-After, after successful requests
+    rate slowly recovers to max_rate. Request can take more tokens (like
+    $batch for all its Graph requests), tokens over capacity are paid back
+    before the next request is sent.
+    '''
+    def __init__(self, max_rate, min_rate=0.5):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.capacity = max(max_rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.blocked_until:
+                    elapsed = max(now - self.updated_at, 0)
+                    self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= min(tokens, self.capacity):
+                        self.tokens -= tokens
+                        return
+                    wait = (min(tokens, self.capacity) - self.tokens) / self.rate
+                else:
+                    wait = self.blocked_until - now
+            time.sleep(wait)
+
+    def throttle(self, retry_after):
+        with self.lock:
+            self.rate = max(self.rate / 2, self.min_rate)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            self.updated_at = self.blocked_until
+            self.tokens = 0
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.rate + self.max_rate / 50, self.max_rate)
+
+
+class GraphClient:
+    '''HTTP client shared by all Graph calls: keeps pool of keep-alive
+    connections, asks for compressed responses, paces requests with token
+    bucket and retries throttled or failed requests with exponential
+    backoff and jitter. Records latency of every request.
+    '''
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    THROTTLE_STATUSES = {429, 503}
+    BATCH_SIZE = 20
+
+    def __init__(self, headers, pool_size=10, rate=10, attempts=5, timeout=60, logger=None,
+                 refresh_authorization=None):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update(headers)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.rate_limiter = TokenBucket(rate)
+        self.attempts = attempts
+        self.timeout = timeout
+        self.refresh_authorization = refresh_authorization
+        self.authorization_lock = threading.Lock()
+        self.logger = logger or logging.getLogger(__name__)
+        self.stats_lock = threading.Lock()
+        self.latencies = []
+        self.throttled = 0
+        self.retries = 0
+        self.bytes_received = 0
+
+    def get(self, url):
+        '''Returns streamed response (body is read with read_content),
+        retries throttled and failed requests. When access token expires
+        (401), it is refreshed with refresh_authorization and retried.
+        '''
+        return self._send(self.session.get, url)
+
+    def post(self, url, json_body, tokens=1):
+        '''Like get, but posts json_body. Request takes tokens from rate
+        limiter, so --rate counts Graph requests sent in $batch too.
+        '''
+        return self._send(self.session.post, url, tokens, json=json_body)
+
+    def _send(self, send, url, tokens=1, **kwargs):
+        for attempt in range(self.attempts):
+            is_last_attempt = attempt == self.attempts - 1
+            self.rate_limiter.acquire(tokens)
+            sent_authorization = self.session.headers.get('Authorization')
+            started_at = time.monotonic()
+            try:
+                response = send(url, timeout=self.timeout, stream=True, **kwargs)
+            except requests.RequestException as e:
+                if is_last_attempt:
+                    raise
+                self.logger.warning(f'{e}, retrying {url}')
+                self._sleep_before_retry(attempt)
+                continue
+            self._record_latency(time.monotonic() - started_at)
+
+            if response.status_code == 401 and self.refresh_authorization and not is_last_attempt:
+                self.read_content(response)
+                self.logger.warning(f'Status 401, refreshing access token for {url}')
+                self._refresh_authorization(sent_authorization)
+                continue
+            if response.status_code not in self.RETRY_STATUSES or is_last_attempt:
+                self.rate_limiter.recover()
+                return response
+            self.read_content(response)
+            retry_after = self._get_retry_after(response.headers)
+            self.logger.warning(f'Status {response.status_code}, retrying {url}')
+            self._slow_down(response.status_code, retry_after, attempt)
+            self._sleep_before_retry(attempt, retry_after)
+
+    def batch_get(self, batch_url, urls):
+        '''Gets up to BATCH_SIZE urls (relative to Graph version root) with
+        one JSON $batch request. Only items which failed (throttled, server
+        errors, expired token) are sent again in the next $batch request.
+        Throttled items slow down rate limiter once per $batch response,
+        with the longest Retry-After of them.
+        Returns list of (status, content bytes) in order of urls.
+        '''
+        pending = dict(enumerate(urls))
+        results = {}
+        for attempt in range(self.attempts):
+            is_last_attempt = attempt == self.attempts - 1
+            sent_authorization = self.session.headers.get('Authorization')
+            response = self.post(batch_url, {
+                'requests': [{'id': str(index), 'method': 'GET', 'url': url} for index, url in pending.items()]
+            }, tokens=len(pending))
+            if not response.ok:
+                response.close()
+                response.raise_for_status()
+            retry_after = None
+            is_unauthorized = False
+            has_failed = False
+            throttle_status = None
+            for item in json.loads(self.read_content(response))['responses']:
+                index = int(item['id'])
+                status = item['status']
+                headers = item.get('headers') or {}
+                if status == 401 and self.refresh_authorization and not is_last_attempt:
+                    is_unauthorized = True
+                elif status in self.RETRY_STATUSES and not is_last_attempt:
+                    has_failed = True
+                    item_retry_after = self._get_retry_after(headers)
+                    if item_retry_after is not None:
+                        retry_after = max(retry_after or 0, item_retry_after)
+                    if status in self.THROTTLE_STATUSES:
+                        throttle_status = status
+                else:
+                    results[index] = (status, self._decode_batch_body(item.get('body'), headers))
+                    del pending[index]
+            if not pending:
+                break
+            if throttle_status:
+                self._slow_down(throttle_status, retry_after, attempt)
+            self.logger.warning(f'Retrying {len(pending)} of {len(urls)} batch requests')
+            if is_unauthorized:
+                self._refresh_authorization(sent_authorization)
+            if has_failed:
+                self._sleep_before_retry(attempt, retry_after)
+        return [results[index] for index in range(len(urls))]
+
+    @staticmethod
+    def _decode_batch_body(body, headers):
+        '''Returns bytes of $batch item body. JSON bodies are objects, other
+        content types (like page html) are base64 encoded strings.
+        '''
+        if body is None:
+            return b''
+        if not isinstance(body, str):
+            return json.dumps(body).encode()
+        if 'json' in headers.get('Content-Type', ''):
+            return body.encode()
+        try:
+            return base64.b64decode(body, validate=True)
+        except binascii.Error:
+            return body.encode()
+
+    def _slow_down(self, status, retry_after, attempt):
+        if status in self.THROTTLE_STATUSES:
+            with self.stats_lock:
+                self.throttled += 1
+            self.rate_limiter.throttle(retry_after or self.backoff(attempt))
+
+    def _refresh_authorization(self, sent_authorization):
+        '''Refreshes Authorization header once, even if many requests
+        sent with the same expired token get 401 at the same time
+        '''
+        with self.authorization_lock:
+            if self.session.headers.get('Authorization') == sent_authorization:
+                self.session.headers['Authorization'] = self.refresh_authorization()
+
+    def read_content(self, response, chunk_size=64 * 1024):
+        '''Reads response body in chunks into one buffer, without keeping
+        another copy of it in response, and releases the connection
+        '''
+        content = bytearray()
+        try:
+            for chunk in response.iter_content(chunk_size):
+                content += chunk
+        finally:
+            response.close()
+        with self.stats_lock:
+            self.bytes_received += len(content)
+        return content
+
+    def save_content(self, response, file, chunk_size=64 * 1024):
+        '''Writes response body to file in chunks and releases the
+        connection, returns sha256 hex digest of the body
+        '''
+        content_hash = hashlib.sha256()
+        try:
+            for chunk in response.iter_content(chunk_size):
+                content_hash.update(chunk)
+                file.write(chunk)
+                with self.stats_lock:
+                    self.bytes_received += len(chunk)
+        finally:
+            response.close()
+        return content_hash.hexdigest()
+
+    def _sleep_before_retry(self, attempt, retry_after=None):
+        with self.stats_lock:
+            self.retries += 1
+        time.sleep(max(retry_after or 0, self.backoff(attempt)))
+
+    @staticmethod
+    def backoff(attempt, base=1, cap=60):
+        '''Returns exponential backoff delay with jitter'''
+        return random.uniform(0.5, 1) * min(cap, base * 2 ** attempt)
+
+    @staticmethod
+    def _get_retry_after(headers):
+        try:
+            return float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+    def _record_latency(self, seconds):
+        with self.stats_lock:
+            self.latencies.append(seconds)
+
+    def stats(self):
+        '''Returns summary of recorded requests, latencies in milliseconds'''
+        with self.stats_lock:
+            latencies = sorted(self.latencies)
+            summary = {
+                'requests': len(latencies),
+                'throttled': self.throttled,
+                'retries': self.retries,
+                'bytes_received': self.bytes_received
+            }
+        if latencies:
+            summary['latency_median_ms'] = round(statistics.median(latencies) * 1000, 1)
+            summary['latency_p95_ms'] = round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 1)
+            summary['latency_max_ms'] = round(latencies[-1] * 1000, 1)
+            summary['latency_histogram_ms'] = Metrics.histogram(latencies)
+        return summary
 
 
 class OneNoteDownload:
     '''Can download notebook'''
-    def __init__(self, username):
+
+    def __init__(self, username, workers=1, incremental=False, store=None, rate=10,
+                 graph_url='https://graph.microsoft.com/v1.0', debug=False, batch=False, notebook_listing=False,
+                 metrics=None, resources=False, resource_dir='resources'):
         self.CLIENT_ID = '1f511e95-ec2f-49b9-a52d-0f164d091f05'
         self.AUTHORITY = 'https://login.microsoftonline.com/common'
-        self.URL_SECTIONS = f'https://graph.microsoft.com/v1.0/users/{username}/onenote/sections'
-        self.URL_PAGES = f'https://graph.microsoft.com/v1.0/users/{username}/onenote/pages'
+        self.URL_SECTIONS = f'{graph_url}/users/{username}/onenote/sections'
+        self.URL_PAGES = f'{graph_url}/users/{username}/onenote/pages'
+        self.URL_BATCH = f'{graph_url}/$batch'
+        self.LISTING_PAGE_SIZE = 100
+        self.SECTION_FIELDS = 'id,displayName,lastModifiedDateTime'
+        self.PAGE_FIELDS = 'id,title,lastModifiedDateTime'
+        self.graph_url = graph_url
+        self.resource_url = re.compile(
+            re.escape(graph_url) + r'/[^\s"<>]*?/onenote/resources/([^/\s"\'<>]+)/\$value'
+        )
+        self.workers = workers
+        self.incremental = incremental
+        self.store = store
+        self.debug = debug
+        self.batch = batch
+        self.notebook_listing = notebook_listing
+        self.notebook_pages = None
+        self.resources = resources
+        self.resource_dir = resource_dir
+        self.metrics = metrics or Metrics()
+        self.pages_downloaded = 0
+        self.pages_unchanged = 0
+        self.pages_resumed = 0
+        self.pages_failed = 0
+        self.bytes_downloaded = 0
+        self.resources_downloaded = 0
+        self.resources_cached = 0
         self.logger = setup_logger()
-        access_token = self.get_access_token()
+        self.app = None
+        self.account = None
+        with self.metrics.phase('auth'):
+            access_token = self.get_access_token()
         self.headers = {'Authorization': f'{access_token}'}
+        self.client = GraphClient(
+            self.headers,
+            pool_size=max(workers * 2 if resources else workers, 10),
+            rate=rate,
+            logger=self.logger,
+            refresh_authorization=self.refresh_access_token
+        )
         self.section_data = self._get_sections_data()
 
+    def stats(self):
+        '''Returns metrics of phases, requests of client and page counters'''
+        stats = self.metrics.summary()
+        stats['requests'] = self.client.stats()
+        stats['pages'] = {
+            'downloaded': self.pages_downloaded,
+            'unchanged': self.pages_unchanged,
+            'resumed': self.pages_resumed,
+            'failed': self.pages_failed,
+        }
+        stats['resources'] = {'downloaded': self.resources_downloaded, 'cached': self.resources_cached}
+        stats['bytes_downloaded'] = self.bytes_downloaded
+        return stats
+
     def get_access_token(self):
         '''Get access token from cache or request new'''
-        cache = SerializableTokenCache()
+        cache = msal.SerializableTokenCache()
         if os.path.exists('token_cache.bin'):
             cache.deserialize(open('token_cache.bin', 'r').read())
-        if cache.has_state_changed:
-            atexit.register(lambda: open('token_cache.bin', 'w').write(cache.serialize()))
 
-        app = PublicClientApplication(self.CLIENT_ID, authority=self.AUTHORITY, token_cache=cache)
+        def save_cache():
+            if cache.has_state_changed:
+                with open('token_cache.bin', 'w') as f:
+                    f.write(cache.serialize())
+        atexit.register(save_cache)
+
+        app = msal.PublicClientApplication(self.CLIENT_ID, authority=self.AUTHORITY, token_cache=cache)
+        self.app = app
 
         token_response = None
         accounts = app.get_accounts()
@@ -45,6 +1086,7 @@ class OneNoteDownload:
                 print(index, account["username"])
             account_nr = int(input("Type number: "))
             chosen = accounts[account_nr]
+            self.account = chosen
             token_response = app.acquire_token_silent(["Notes.Read"], account=chosen)
 
         if not token_response:
@@ -57,6 +1099,8 @@ class OneNoteDownload:
                 print(f'Code {auth_code} has been copied to clipboard.')
 
             token_response = app.acquire_token_by_device_flow(flow)
+            username = token_response.get('id_token_claims', {}).get('preferred_username')
+            self.account = next(iter(app.get_accounts(username=username)), None)
         if "access_token" in token_response:
             return token_response["access_token"]
         else:
@@ -64,45 +1108,324 @@ class OneNoteDownload:
             print(token_response.get("error_description"))
             print(token_response.get("correlation_id"))
 
+    def refresh_access_token(self):
+        '''Returns new access token from MSAL cache (using refresh token),
+        without interaction, so long download can continue
+        '''
+        if self.app is None or self.account is None:
+            raise RuntimeError('Access token expired and can not be refreshed, run again to resume download.')
+        token_response = self.app.acquire_token_silent(["Notes.Read"], account=self.account, force_refresh=True)
+        if not token_response or "access_token" not in token_response:
+            raise RuntimeError('Access token expired and can not be refreshed, run again to resume download.')
+        self.logger.info('Access token refreshed.')
+        return token_response["access_token"]
+
     def download(self):
-        for section_name, section_dict in self.section_data.items():
-            print(f"Reading section: {section_name}, {section_dict['id']}")
-            pages = self.get_pages(section_name)
-            all_section_notes = {}
-            for title, page_id in pages.items():
-                print(f'Reading page: {title}')
-                all_section_notes[title] = self.get_note_html(page_id)
-                with shelve.open('shelve.lib') as lib:
-                    lib[section_name] = all_section_notes
-
-        seconds_taken = int(time.monotonic() - started_at)
-        time_taken = datetime.timedelta(seconds=seconds_taken)
-        print(f'Finished in {time_taken} minutes')
+        '''Downloads all sections to the store, fetching page contents with
+        a pool of workers, interrupted download is resumed
+        '''
+        started_at = time.monotonic()
+        if self.store is None:
+            self.store = PageStore()
+        self.pages_downloaded = 0
+        self.pages_unchanged = 0
+        self.pages_resumed = 0
+        self.pages_failed = 0
+        self.failed_sections = set()
+        self.resources_downloaded = 0
+        self.resources_cached = 0
+        bytes_received_before = self.client.bytes_received
+        self.counters_lock = threading.Lock()
+        if self.resources:
+            os.makedirs(self.resource_dir, exist_ok=True)
+            self.resource_paths = self.store.get_resource_paths()
+            self.new_resource_paths = {}
+            self.resource_futures = {}
+        self.pending_pages = deque()
+        self.pending_sections = deque()
+        self.batch_pages = []
+        self.notebook_pages = None
+        self.window = 2 * self.workers * (GraphClient.BATCH_SIZE if self.batch else 1)
+        for section_name in self.store.remove_sections_except(self.section_data):
+            print(f'Removing deleted section: {section_name}')
+        if self.store.has_checkpoint():
+            print('Resuming interrupted download.')
 
-    def _get_sections_data(self):
-        '''Returns dict with mapping: {section name: section data}'''
-        sections_data = {}
-        next_link = self.URL_SECTIONS
+        try:
+            self._download_sections()
+        except KeyboardInterrupt:
+            print('Download interrupted, run it again to resume.')
+            raise
+        with self.metrics.phase('store cleanup'):
+            self.store.clear_checkpoint()
+            self.store.remove_unused_contents()
+            self.store.compress_pages()
 
-        while next_link:
-            for attempt in range(3):
-                try:
-                    sections_data.update(self._get_sections_data_from_link(next_link))
-                    break
-                except Exception as e:
-                    self.logger.warning(e)
-                    self.logger.warning(f'Retrying {attempt} time.')
-                    time.sleep(2)
-
-            sections_dict = self._get_response_json(next_link)
-            next_link = sections_dict.get('@odata.nextLink')
+        self.bytes_downloaded = self.client.bytes_received - bytes_received_before
+        self._print_throughput(time.monotonic() - started_at)
 
-        return sections_data
+    def _download_sections(self):
+        with concurrent.futures.ProcessPoolExecutor() as text_executor, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as resource_executor:
+            self.text_executor = text_executor
+            self.resource_executor = resource_executor
+            for section_position, (section_name, section_dict) in enumerate(self.section_data.items()):
+                if self._is_section_unchanged(section_name):
+                    print(f"Section unchanged: {section_name}")
+                    continue
+                if self._is_section_resumed(section_name):
+                    print(f"Section already downloaded: {section_name}")
+                    continue
+                print(f"Reading section: {section_name}, {section_dict['id']}")
+                page_states = self.store.get_page_states(section_name)
+                checkpoint_pages = self.store.get_checkpoint_pages(section_name)
+                page_ids = []
+                for page_data in self._iter_section_pages(section_name):
+                    title = page_data.get('title') or ''
+                    page_ids.append(page_data['id'])
+                    if self._is_page_unchanged(page_states.get(page_data['id']), page_data):
+                        self.pages_unchanged += 1
+                        continue
+                    if checkpoint_pages.get(page_data['id']) == page_data['lastModifiedDateTime']:
+                        self.pages_resumed += 1
+                        continue
+                    print(f'Reading page: {title}')
+                    while len(self.pending_pages) >= self.window:
+                        if self.batch_pages and self.pending_pages[0][-1] is self.batch_pages[0][1]:
+                            self._flush_batch(executor)
+                        self._store_first_pending_page()
+                    future = self._submit_page(executor, page_data['id'])
+                    self.pending_pages.append((section_name, title, page_data, len(page_ids) - 1, future))
+                    self._store_done_pages()
+                self.pending_sections.append((section_name, section_dict, section_position, page_ids))
+                self._store_done_pages()
+
+            self._flush_batch(executor)
+            while self.pending_pages:
+                self._store_first_pending_page()
+            self._store_done_pages()
+
+    def _is_section_unchanged(self, section_name):
+        if not self.incremental:
+            return False
+        section_dict = self.section_data[section_name]
+        return self.store.get_section_state(section_name) == (
+            section_dict['id'], section_dict['lastModifiedDateTime']
+        )
+
+    def _is_section_resumed(self, section_name):
+        section_dict = self.section_data[section_name]
+        return self.store.get_checkpoint_section(section_name) == (
+            section_dict['id'], section_dict['lastModifiedDateTime']
+        )
+
+    def _is_page_unchanged(self, modified, page_data):
+        if not self.incremental:
+            return False
+        return modified == page_data['lastModifiedDateTime']
+
+    def _submit_page(self, executor, page_id):
+        '''Returns future of (page html, future of page text). In batch mode
+        page waits in current batch, which is sent when it is full
+        '''
+        if not self.batch:
+            return executor.submit(self._fetch_page, page_id)
+        future = concurrent.futures.Future()
+        self.batch_pages.append((page_id, future))
+        if len(self.batch_pages) == GraphClient.BATCH_SIZE:
+            self._flush_batch(executor)
+        return future
+
+    def _flush_batch(self, executor):
+        if self.batch_pages:
+            executor.submit(self._fetch_batch, self.batch_pages)
+            self.batch_pages = []
+
+    def _fetch_batch(self, batch_pages):
+        '''Fetches contents of pages with one $batch request (failed items
+        are retried by the client) and sets results of their futures
+        '''
+        relative_url_pages = self.URL_PAGES[len(self.graph_url):]
+        try:
+            with self.metrics.phase('batch fetch'):
+                results = self.client.batch_get(
+                    self.URL_BATCH, [f'{relative_url_pages}/{page_id}/content' for page_id, _ in batch_pages]
+                )
+        except Exception as e:
+            for _, future in batch_pages:
+                future.set_exception(e)
+            return
+        for (page_id, future), (status, content) in zip(batch_pages, results):
+            if status >= 400:
+                future.set_exception(requests.HTTPError(f'{status} Error for page {page_id}'))
+                continue
+            html = content.decode('utf-8', errors='replace')
+            if self.resources:
+                html = self._localize_resources(html)
+            with self.counters_lock:
+                self.pages_downloaded += 1
+            future.set_result((html, self.text_executor.submit(extract_text_timed, html)))
+
+    def _fetch_page(self, page_id):
+        '''Returns page html and future of (text extracted from it, seconds
+        taken by extraction)
+        '''
+        with self.metrics.phase('content fetch'):
+            html = self.get_note_html(page_id)
+        if self.resources:
+            html = self._localize_resources(html)
+        with self.counters_lock:
+            self.pages_downloaded += 1
+        return html, self.text_executor.submit(extract_text_timed, html)
+
+    def _localize_resources(self, html):
+        '''Downloads resources (images, attachments) referenced by page html
+        to local cache, concurrently with resource workers, and returns html
+        pointing to cached files. Only URLs on Graph host are downloaded
+        (with access token), other URLs are left untouched. Resources cached
+        by previous pages or downloads are not downloaded again, resources
+        which fail to download are left pointing to Graph.
+        '''
+        resource_urls = {match.group(1): match.group(0) for match in self.resource_url.finditer(html)}
+        futures = {
+            resource_id: self._get_resource_future(resource_id, url) for resource_id, url in resource_urls.items()
+        }
+        paths = {}
+        for resource_id, future in futures.items():
+            try:
+                paths[resource_id] = future.result()
+            except Exception as e:
+                self.logger.warning(f'Resource {resource_id} not downloaded: {e}')
+        return self.resource_url.sub(lambda match: paths.get(match.group(1), match.group(0)), html)
+
+    def _get_resource_future(self, resource_id, url):
+        '''Returns future of path of cached resource, resource is submitted
+        for download only if it is not cached or being downloaded already
+        '''
+        with self.counters_lock:
+            path = self.resource_paths.get(resource_id)
+            if path and os.path.exists(path):
+                self.resources_cached += 1
+                future = concurrent.futures.Future()
+                future.set_result(path)
+                return future
+            if resource_id not in self.resource_futures:
+                self.resource_futures[resource_id] = self.resource_executor.submit(
+                    self._fetch_resource, resource_id, url
+                )
+            return self.resource_futures[resource_id]
+
+    def _fetch_resource(self, resource_id, url):
+        '''Streams resource to cache file named by sha256 of its content
+        (with extension by content type), so identical resources are kept
+        once. Returns path of the file.
+        '''
+        with self.metrics.phase('resource fetch'):
+            response = self.client.get(url)
+            if not response.ok:
+                response.close()
+                response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+            extension = mimetypes.guess_extension(content_type) or ''
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=self.resource_dir)
+            try:
+                with os.fdopen(file_descriptor, 'wb') as f:
+                    content_hash = self.client.save_content(response, f)
+                path = f'{self.resource_dir}/{content_hash}{extension}'
+                os.replace(temporary_path, path)
+            except BaseException:
+                os.remove(temporary_path)
+                raise
+        with self.counters_lock:
+            self.resource_paths[resource_id] = path
+            self.new_resource_paths[resource_id] = path
+            self.resources_downloaded += 1
+            del self.resource_futures[resource_id]
+        return path
+
+    @staticmethod
+    def _is_page_ready(future):
+        if not future.done():
+            return False
+        return future.exception() is not None or future.result()[1].done()
+
+    def _store_first_pending_page(self):
+        '''Waits for the oldest page in flight and writes it to the store.
+        Page which failed to download is skipped and its section is not
+        marked as downloaded, so the next run fetches it again.
+        '''
+        section_name, title, page_data, position, future = self.pending_pages.popleft()
+        try:
+            html, text_future = future.result()
+        except requests.RequestException as e:
+            self.logger.warning(f"Page {title} ({page_data['id']}) not downloaded: {e}")
+            self.pages_failed += 1
+            self.failed_sections.add(section_name)
+            return
+        text, parse_seconds = text_future.result()
+        if self.resources:
+            self._store_new_resources()
+        self.metrics.record('parse', parse_seconds)
+        with self.metrics.phase('store write'):
+            self.store.put_page(
+                section_name, title, page_data['id'], page_data['lastModifiedDateTime'], html, position,
+                text=text, checkpoint=True
+            )
+
+    def _store_new_resources(self):
+        '''Saves paths of resources downloaded since last call, before page
+        pointing to them is saved
+        '''
+        with self.counters_lock:
+            new_resource_paths, self.new_resource_paths = self.new_resource_paths, {}
+        if new_resource_paths:
+            self.store.put_resources(new_resource_paths)
+
+    def _store_done_pages(self):
+        '''Writes finished pages to the store and marks sections, which have
+        all pages written, as downloaded
+        '''
+        while self.pending_pages and self._is_page_ready(self.pending_pages[0][-1]):
+            self._store_first_pending_page()
+        while self.pending_sections and not self._has_pending_pages(self.pending_sections[0][0]):
+            section_name, section_dict, section_position, page_ids = self.pending_sections.popleft()
+            modified = None if section_name in self.failed_sections else section_dict['lastModifiedDateTime']
+            with self.metrics.phase('section write'):
+                self.store.put_section(
+                    section_name, section_dict['id'], modified, section_position, page_ids, checkpoint=True
+                )
+
+    def _has_pending_pages(self, section_name):
+        return bool(self.pending_pages) and self.pending_pages[0][0] == section_name
 
-    def _get_sections_data_from_link(self, link):
+    def _print_throughput(self, seconds_taken):
+        time_taken = datetime.timedelta(seconds=int(seconds_taken))
+        seconds_taken = max(seconds_taken, 0.001)
+        print(
+            f'Downloaded {self.pages_downloaded} pages '
+            f'({self.bytes_downloaded / 1024 / 1024:.1f} MB) in {time_taken} with {self.workers} workers: '
+            f'{self.pages_downloaded / seconds_taken:.1f} pages/s, '
+            f'{self.bytes_downloaded / 1024 / seconds_taken:.1f} KB/s, '
+            f'{self.pages_unchanged} pages unchanged, {self.pages_resumed} pages resumed, '
+            f'{self.pages_failed} pages failed'
+        )
+        if self.resources:
+            print(f'Resources: {self.resources_downloaded} downloaded, {self.resources_cached} already cached')
+        client_stats = self.client.stats()
+        if client_stats['requests']:
+            print(
+                f"Requests: {client_stats['requests']}, "
+                f"latency median {client_stats['latency_median_ms']} ms, "
+                f"p95 {client_stats['latency_p95_ms']} ms, max {client_stats['latency_max_ms']} ms, "
+                f"throttled: {client_stats['throttled']}, retries: {client_stats['retries']}"
+            )
+
+    def _get_sections_data(self):
+        '''Returns dict with mapping: {section name: section data}'''
         sections_data = {}
-        sections = self._get_response_json(link)
-        for section in sections['value']:
+        sections_link = f'{self.URL_SECTIONS}?$select={self.SECTION_FIELDS}&$top={self.LISTING_PAGE_SIZE}'
+        for section in self._iter_link_values(sections_link, 'section listing'):
             section_name = section["displayName"]
             if section_name in sections_data:  # if sections are duplicated
                 existing_date = parser.isoparse(sections_data[section_name]["lastModifiedDateTime"])
@@ -113,132 +1436,203 @@ class OneNoteDownload:
                 sections_data[section_name] = section
         return sections_data
 
+    def _iter_link_values(self, link, phase='page listing'):
+        '''Yields items of paginated listing, every page of results is
+        requested once and @odata.nextLink from it is followed
+        '''
+        next_link = link
+        while next_link:
+            print(f'Reading next link: {next_link}')
+            with self.metrics.phase(phase):
+                response = self._get_listing_json(next_link)
+            yield from response['value']
+            next_link = response.get('@odata.nextLink')
+
+    def _get_listing_json(self, link, attempts=3):
+        '''Returns one page of listing, retries invalid responses with
+        exponential backoff (HTTP errors are retried by the client)
+        '''
+        for attempt in range(attempts):
+            try:
+                response = self._get_response_json(link)
+                if 'value' not in response:
+                    raise ValueError(f'Unexpected listing response: {response.get("error", response)}')
+                return response
+            except Exception as e:
+                self.logger.warning(e)
+                if attempt == attempts - 1:
+                    raise
+                self.logger.warning(f'Retrying {attempt} time.')
+                time.sleep(GraphClient.backoff(attempt + 1))
+
     def _get_response_json(self, link):
-        resp = requests.get(link, headers=self.headers)
-        return json.loads(resp.text)
+        resp = self.client.get(link)
+        return json.loads(self.client.read_content(resp))
 
     def get_pages(self, section_name):
         '''Returns dict with mapping: {page title: page id}'''
-        section_id = self.section_data.get(section_name).get('id')
-        all_pages = {}
-        next_link = f'{self.URL_SECTIONS}/{section_id}/pages'
-
-        while next_link:
-            print(f'Reading next link: {next_link}')
+        return {page_data.get('title'): page_data.get('id') for page_data in self.iter_pages_data(section_name)}
 
-            for attempt in range(3):
-                try:
-                    all_pages.update(self._get_pages_from_link(next_link))
-                    break
-                except Exception as e:
-                    self.logger.warning(e)
-                    self.logger.warning(f'Retrying {attempt} time.')
-                    time.sleep(2)
-            pages_response = self._get_response_json(next_link)
-            next_link = pages_response.get('@odata.nextLink')
+    def iter_pages_data(self, section_name):
+        '''Yields page data of section while its listing is paginated'''
+        section_id = self.section_data.get(section_name).get('id')
+        return self._iter_link_values(
+            f'{self.URL_SECTIONS}/{section_id}/pages?$select={self.PAGE_FIELDS}&$top={self.LISTING_PAGE_SIZE}'
+        )
 
-        return all_pages
+    def get_notebook_pages_data(self):
+        '''Returns dict with mapping: {section id: [page data]} of all pages
+        in notebook, listed with one pagination chain
+        '''
+        pages_link = (
+            f'{self.URL_PAGES}?$select={self.PAGE_FIELDS}&$expand=parentSection($select=id)'
+            f'&$top={self.LISTING_PAGE_SIZE}'
+        )
+        notebook_pages = {}
+        for page_data in self._iter_link_values(pages_link):
+            section_id = (page_data.get('parentSection') or {}).get('id')
+            notebook_pages.setdefault(section_id, []).append(page_data)
+        return notebook_pages
 
-    def _get_pages_from_link(self, link):
-        pages = {}
-        pages_response = self._get_response_json(link)
-        for pages_data in pages_response.get('value'):
-            pages[pages_data.get("title")] = pages_data.get("id")
-        return pages
+    def _iter_section_pages(self, section_name):
+        '''Yields page data of section, from notebook wide listing (made
+        once, when first section needs it) in notebook listing mode
+        '''
+        if not self.notebook_listing:
+            return self.iter_pages_data(section_name)
+        if self.notebook_pages is None:
+            self.notebook_pages = self.get_notebook_pages_data()
+        return iter(self.notebook_pages.get(self.section_data[section_name]['id'], []))
 
     def get_note_text(self, note_id):
-        '''Not used yet'''
-        html = self.get_note_html(note_id)
-        soup = BeautifulSoup(html, features='lxml')
-        return soup.text
+        return extract_text(self.get_note_html(note_id))
 
     def get_note_html(self, note_id):
-        '''Not used yet'''
-        resp = requests.get(f'{self.URL_PAGES}/{note_id}/content', headers=self.headers)
-        with open('page.txt', 'w') as f:
-            f.write(resp.text)
-        return resp.text
+        '''Returns page html, body is streamed in chunks and decoded once.
+        In debug mode the last page is also saved to page.txt.
+        '''
+        resp = self.client.get(f'{self.URL_PAGES}/{note_id}/content')
+        if not resp.ok:
+            resp.close()
+            resp.raise_for_status()
+        encoding = resp.encoding if 'charset' in resp.headers.get('Content-Type', '') else 'utf-8'
+        html = self.client.read_content(resp).decode(encoding, errors='replace')
+        if self.debug:
+            with open('page.txt', 'w') as f:
+                f.write(html)
+        return html
 
 
 class OneNoteOffline:
     '''For reading offline data'''
-    def __init__(self):
-        with shelve.open('shelve.lib') as lib:
-            self.notes = dict(lib)
+    PROMPT = 'onenote> '
+    EXPORT_FORMATS = ('md', 'html', 'txt')
+    EXPORT_MANIFEST = '.onenote-export.json'
 
-    def _find_titles_with_keyword(self, section, keyword):
-        return [
-            title for title in self.notes[section].keys()
-            if keyword.casefold() in title.casefold()
-        ]
+    def __init__(self, store=None, metrics=None):
+        self.metrics = metrics or Metrics()
+        with self.metrics.phase('open store'):
+            self.store = store or PageStore()
+        self.notes = self.store.notes()
+        self.data_version = self.store.data_version()
 
-    def _find_titles_with_keyword_in_page(self, section, keyword):
-        return [
-            title for title, page in self.notes[section].items()
-            if keyword.casefold() in page.casefold()
-        ]
+    def stats(self):
+        '''Returns metrics of queries answered so far'''
+        return self.metrics.summary()
+
+    def _refresh(self):
+        '''Drops section names and titles read by notes view, if store was
+        changed since, so long running session sees new download
+        '''
+        data_version = self.store.data_version()
+        if data_version != self.data_version:
+            self.notes = self.store.notes()
+            self.data_version = data_version
+
+    def _find_titles_with_keyword(self, section, keyword):
+        with self.metrics.phase('title lookup'):
+            return [title for _, title in self.store.find_titles(keyword, section)]
 
     def _find_sections_with_keyword(self, keyword):
-        return [
-            section_name for section_name in self.notes.keys()
-            if keyword.casefold() in section_name.casefold()
-        ]
+        with self.metrics.phase('section lookup'):
+            return self.store.find_sections(keyword)
+
+    def _get_texts(self, section_name, title):
+        with self.metrics.phase('page read'):
+            return self.store.get_texts(section_name, title)
 
     def _display_titles_with_keyword_in_page(self, keyword):
+        '''Shows titles of pages with keyword in text, answered from full
+        text index of the store
+        '''
         print('Following titles have  been found:')
-        for section_name in self.notes:
-            titles_with_keyword_in_page = self._find_titles_with_keyword_in_page(section_name, keyword)
-            if titles_with_keyword_in_page:
+        previous_section_name = None
+        with self.metrics.phase('search'):
+            found = self.store.search(keyword)
+        for section_name, title, snippet in found:
+            if section_name != previous_section_name:
                 print(f'##### SECTION: {section_name} #####')
-                for title in titles_with_keyword_in_page:
-                    print(f'          TITLE: {title}')
+                previous_section_name = section_name
+            print(f'          TITLE: {title}')
+            print(f'                    {snippet}')
 
     def _print_all_sections(self):
         print('\n'.join(self.notes.keys()))
 
     def _print_all_titles_in_section(self, section_name):
-        print('\n'.join(self.notes[section_name].keys()))
+        titles = self.store.titles(section_name)
+        if not titles:
+            raise KeyError(section_name)
+        print('\n'.join(titles))
 
     def _print_note(self, section_name, title):
-        '''Shows specific note. If more sections match it only shows
-        sections. If one sections, but more titles match, it shows all
-        notes with matching titles
+        '''Shows specific note. If more sections match (and none of them
+        is named exactly section_name) it only shows sections. If one
+        sections, but more titles match, it shows all notes with matching
+        titles
         '''
         sections = self._find_sections_with_keyword(section_name)
+        exact_sections = [name for name in sections if name.casefold() == section_name.casefold()]
+        if len(exact_sections) == 1:
+            sections = exact_sections
         if len(sections) == 0:
             print('Provided section name not found.')
         elif len(sections) == 1:
             section_name = sections[0]
             titles_with_keyword = self._find_titles_with_keyword(section_name, title)
             print(f'##### SECTION: {section_name} #####')
-            for title in titles_with_keyword:
-                print(f'##### TITLE: {title}')
-                soup = BeautifulSoup(self.notes[section_name][title], features='lxml')
-                print(soup.text)
+            for title in dict.fromkeys(titles_with_keyword):
+                for text in self._get_texts(section_name, title):
+                    print(f'##### TITLE: {title}')
+                    print(text)
         elif len(sections) > 1:
             print(f'Section name : {section_name}, matches more than one section: {sections}.')
 
     def _print_titles_with_keyword(self, keyword):
-        '''Finds titles with keyword, but if only one is found, it
-        shows note
+        '''Finds titles with keyword (or similar titles if none contains it),
+        sections with the best matches are shown first. If only one title is
+        found, it shows note
         '''
         print('Following titles have been found in all sections:')
-        found = []
-        for section_name in self.notes:
-            titles_with_keyword = self._find_titles_with_keyword(section_name, keyword)
-            if titles_with_keyword:
-                print(f'##### SECTION: {section_name} #####')
-                for title in titles_with_keyword:
-                    found.append({'section_name': section_name, 'title': title})
-                    print(f'          TITLE: {title}')
+        with self.metrics.phase('title lookup'):
+            found = self.store.find_titles(keyword)
+        titles_by_section = {}
+        for section_name, title in found:
+            titles_by_section.setdefault(section_name, []).append(title)
+        for section_name, titles_with_keyword in titles_by_section.items():
+            print(f'##### SECTION: {section_name} #####')
+            for title in titles_with_keyword:
+                print(f'          TITLE: {title}')
 
         if len(found) == 1:
-            title = found[0]['title']
-            section = found[0]['section_name']
-            soup = BeautifulSoup(self.notes[section][title], features='lxml')
-            print(soup.text)
+            section, title = found[0]
+            print(self._get_texts(section, title)[0])
 
     def display_notes(self, args):
+        with self.metrics.phase('query'):
+            self._display_notes(args)
+
+    def _display_notes(self, args):
         if args.find:
             self._display_titles_with_keyword_in_page(args.find)
         elif args.allsections:
@@ -250,6 +1644,263 @@ class OneNoteOffline:
         elif args.title:
             self._print_titles_with_keyword(args.title)
 
+    def export(self, directory, export_format='md', workers=None):
+        '''Exports notebook to directory tree: folder per section, file per
+        page. Pages are read from the store one by one and converted in a
+        process pool, with at most 2 * workers pages in flight. Versions of
+        exported pages are kept in manifest file in directory, so only pages
+        changed since last export are written again and files of removed
+        pages are deleted. Returns counts of written, unchanged and removed
+        pages.
+        '''
+        manifest_path = os.path.join(directory, self.EXPORT_MANIFEST)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            manifest = {}
+        previous_pages = manifest.get('pages', {})
+        if manifest.get('format') != export_format:
+            previous_versions = {}
+        else:
+            previous_versions = previous_pages
+        base_dir = os.path.dirname(os.path.abspath(self.store.path))
+        workers = workers or os.cpu_count()
+        pages = {}
+        used_paths = set()
+        written = 0
+        with self.metrics.phase('export'), concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            pending = deque()
+            for section_name, title, page_id, version in self.store.iter_page_versions():
+                relative_path = self._get_export_path(section_name, title, export_format, used_paths)
+                pages[relative_path] = version
+                path = os.path.join(directory, relative_path)
+                if previous_versions.get(relative_path) == version and os.path.exists(path):
+                    continue
+                if export_format == 'txt':
+                    content = self.store.get_text(section_name, title, page_id)
+                else:
+                    content = self.store.get_html(section_name, title, page_id)
+                while len(pending) >= 2 * workers:
+                    pending.popleft().result()
+                pending.append(executor.submit(export_page, content, export_format, title, path, base_dir))
+                written += 1
+            while pending:
+                pending.popleft().result()
+
+        removed = [relative_path for relative_path in previous_pages if relative_path not in pages]
+        for relative_path in removed:
+            path = os.path.join(directory, relative_path)
+            if os.path.exists(path):
+                os.remove(path)
+            if os.path.isdir(os.path.dirname(path)) and not os.listdir(os.path.dirname(path)):
+                os.rmdir(os.path.dirname(path))
+        os.makedirs(directory, exist_ok=True)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump({'format': export_format, 'pages': pages}, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        print(
+            f'Exported {written} pages to {directory}, {len(pages) - written} pages unchanged, '
+            f'{len(removed)} pages removed.'
+        )
+        return {'written': written, 'unchanged': len(pages) - written, 'removed': len(removed)}
+
+    @classmethod
+    def _get_export_path(cls, section_name, title, export_format, used_paths):
+        '''Returns path of page file relative to export directory, names are
+        made safe for file systems and names which collide get a number
+        '''
+        name = cls._get_file_name(title)
+        relative_path = os.path.join(cls._get_file_name(section_name), f'{name}.{export_format}')
+        number = 2
+        while relative_path.casefold() in used_paths:
+            relative_path = os.path.join(cls._get_file_name(section_name), f'{name} ({number}).{export_format}')
+            number += 1
+        used_paths.add(relative_path.casefold())
+        return relative_path
+
+    @staticmethod
+    def _get_file_name(name):
+        name = re.sub(r'[\x00-\x1f/\\:*?"<>|]', '_', name).strip().strip('.')
+        return name[:120] or '_'
+
+    def query(self, argv):
+        '''Answers query given as command line arguments (like ['-t', 'cron'])
+        and returns its output, as printed by display_notes. Errors of query
+        are returned as output, so they do not end session or server
+        '''
+        self._refresh()
+        output = io.StringIO()
+        with redirect_stdout(output), redirect_stderr(output):
+            try:
+                self.display_notes(parse_arguments(argv))
+            except SystemExit:
+                pass
+            except LookupError:
+                print('Provided section name not found.')
+            except Exception as error:
+                print(f'Query failed: {error!r}')
+        return output.getvalue()
+
+    def interactive(self):
+        '''Answers queries typed as command line options until EOF or quit,
+        store and its indexes are opened only once
+        '''
+        print('Type options like: -t title, -s section --alltitles, -f keyword, --allsections or quit.')
+        while True:
+            try:
+                line = input(self.PROMPT)
+            except EOFError:
+                break
+            if line.strip() in ('quit', 'exit'):
+                break
+            try:
+                argv = shlex.split(line)
+            except ValueError as error:
+                print(error)
+                continue
+            if argv:
+                print(self.query(argv), end='')
+
+    def make_query_server(self, socket_path):
+        '''Returns server answering queries of --connect clients on Unix
+        socket, one at a time (connection to store is not shared between
+        threads). Request is JSON list of arguments, response is output.
+        '''
+        offline = self
+
+        class QueryHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                argv = json.loads(self.rfile.readline())
+                self.wfile.write(offline.query(argv).encode())
+
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.remove(socket_path)
+        return socketserver.UnixStreamServer(socket_path, QueryHandler)
+
+    def serve(self, socket_path):
+        '''Answers queries on Unix socket until interrupted or terminated'''
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        with self.make_query_server(socket_path) as server:
+            print(f'Answering queries on {socket_path}, use --connect {socket_path} with query options.')
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(socket_path)
+
+
+def query_server(socket_path, argv):
+    '''Sends query (command line arguments) to server started with --serve
+    and returns its output
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(argv).encode() + b'\n')
+        client.shutdown(socket.SHUT_WR)
+        return b''.join(iter(lambda: client.recv(65536), b'')).decode()
+
+
+def extract_text(html):
+    '''Returns text of page html, it is run in worker processes'''
+    return bs4.BeautifulSoup(html, features='lxml').text
+
+
+def extract_text_timed(html):
+    '''Returns text of page html and seconds taken by extraction'''
+    started_at = time.perf_counter()
+    return extract_text(html), time.perf_counter() - started_at
+
+
+def export_page(content, export_format, title, path, base_dir):
+    '''Converts page (html, or text for txt format) and writes it to path,
+    it is run in worker processes. Relative links to cached resources
+    (relative to base_dir) are rewritten relative to the page file.
+    '''
+    output_dir = os.path.dirname(path)
+    os.makedirs(output_dir, exist_ok=True)
+    if export_format == 'md':
+        content = html_to_markdown(content, title, lambda url: relocate_url(url, base_dir, output_dir))
+    elif export_format == 'html':
+        content = re.sub(
+            r'\b(src|data|href)="([^"]*)"',
+            lambda match: f'{match.group(1)}="{relocate_url(match.group(2), base_dir, output_dir)}"',
+            content
+        )
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+
+def relocate_url(url, base_dir, output_dir):
+    '''Returns url relative to output_dir, if it is path relative to base_dir'''
+    if not url or re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:|^[/#]', url):
+        return url
+    return os.path.relpath(os.path.join(base_dir, url), output_dir).replace(os.sep, '/')
+
+
+def html_to_markdown(html, title, relocate=lambda url: url):
+    '''Returns Markdown of page html: headings, paragraphs, emphasis,
+    links, images, attachments, lists, tables and preformatted text
+    '''
+    body = bs4.BeautifulSoup(html, features='lxml').body
+    markdown = f'# {title}\n\n' + (_to_markdown(body, relocate) if body else '')
+    return re.sub(r'\n{3,}', '\n\n', markdown).strip() + '\n'
+
+
+def _to_markdown(node, relocate):
+    if isinstance(node, bs4.Comment):
+        return ''
+    if isinstance(node, bs4.NavigableString):
+        return re.sub(r'\s+', ' ', str(node))
+    name = node.name
+    if name in ('script', 'style', 'head', 'title'):
+        return ''
+    if name == 'pre':
+        return f'\n\n```\n{node.get_text()}\n```\n\n'
+    if name == 'br':
+        return '  \n'
+    if name == 'img':
+        return f"![{node.get('alt', '')}]({relocate(node.get('src', ''))})"
+    if name == 'object':
+        return f"[{node.get('data-attachment', 'attachment')}]({relocate(node.get('data', ''))})"
+    if name in ('ul', 'ol'):
+        items = []
+        for number, item in enumerate(node.find_all('li', recursive=False), 1):
+            marker = f'{number}. ' if name == 'ol' else '- '
+            lines = _to_markdown(item, relocate).strip().split('\n')
+            items.append(marker + f'\n{" " * len(marker)}'.join(line.rstrip() for line in lines))
+        return '\n\n' + '\n'.join(items) + '\n\n'
+    if name == 'table':
+        rows = [
+            [
+                _to_markdown(cell, relocate).strip().replace('\n', ' ').replace('|', '\\|')
+                for cell in row.find_all(['td', 'th'])
+            ]
+            for row in node.find_all('tr')
+        ]
+        rows = [row for row in rows if row]
+        if not rows:
+            return ''
+        width = max(len(row) for row in rows)
+        lines = ['| ' + ' | '.join(row + [''] * (width - len(row))) + ' |' for row in rows]
+        lines.insert(1, '|' + ' --- |' * width)
+        return '\n\n' + '\n'.join(lines) + '\n\n'
+    inner = ''.join(_to_markdown(child, relocate) for child in node.children)
+    if name in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
+        return f"\n\n{'#' * int(name[1])} {inner.strip()}\n\n"
+    if name in ('p', 'div'):
+        return f'\n\n{inner.strip()}\n\n'
+    if name in ('b', 'strong') and inner.strip():
+        return f'**{inner.strip()}**'
+    if name in ('i', 'em') and inner.strip():
+        return f'*{inner.strip()}*'
+    if name == 'code':
+        return f'`{inner}`'
+    if name == 'a' and node.get('href'):
+        return f"[{inner.strip()}]({relocate(node['href'])})"
+    return inner
+
 
 def setup_logger():
     logger = logging.getLogger(__name__)
@@ -261,7 +1912,20 @@ def setup_logger():
     return logger
 
 
-def parse_arguments():
+def positive(number_type):
+    '''Returns argparse type converting argument to number greater than 0'''
+    def convert(argument):
+        try:
+            number = number_type(argument)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'invalid {number_type.__name__} value: {argument!r}')
+        if number <= 0:
+            raise argparse.ArgumentTypeError(f'must be greater than 0: {argument!r}')
+        return number
+    return convert
+
+
+def parse_arguments(argv=None):
     arg_parser = argparse.ArgumentParser(
         description='Can download onenote notebook for specific account and read its contents after.'
     )
@@ -270,8 +1934,8 @@ def parse_arguments():
         '--title',
         '-t',
         default=False,
-        help='Find keyword in titles and display the page (if there is only one matching). '
-             'Can use with together with -s to show page from specific section.'
+        help='Find keyword in titles (or similar titles, if no title contains it) and display the page '
+             '(if there is only one matching). Can use with together with -s to show page from specific section.'
     )
     arg_parser.add_argument(
         '--section',
@@ -284,7 +1948,8 @@ def parse_arguments():
         '--find',
         '-f',
         default=False,
-        help='Finds all titles from all sections by keyword in page content'
+        help='Finds all titles from all sections by keywords in page content. '
+             'All words must match, use "some phrase" for phrase and word* for prefix search'
     )
     arg_parser.add_argument(
         "--alltitles",
@@ -292,17 +1957,146 @@ def parse_arguments():
         help='Show all titles in specific section (use with -s)'
     )
     arg_parser.add_argument("--allsections", action="store_true", help='Show all sections')
+    arg_parser.add_argument(
+        '--workers',
+        '-w',
+        type=positive(int),
+        default=4,
+        help='Number of pages downloaded concurrently (use with -u)'
+    )
+    arg_parser.add_argument(
+        '--rate',
+        type=positive(float),
+        default=10,
+        help='Maximum number of Graph requests per second (requests in $batch count one by one), '
+             'it is lowered automatically when throttled (use with -u)'
+    )
+    arg_parser.add_argument(
+        '--batch',
+        action='store_true',
+        help='Download page contents in groups of 20 with Graph $batch requests (use with -u)'
+    )
+    arg_parser.add_argument(
+        '--notebook-listing',
+        action='store_true',
+        help='List pages of all sections with one notebook wide listing instead of listing every section '
+             '(use with -u)'
+    )
+    arg_parser.add_argument(
+        '--resources',
+        action='store_true',
+        help="Download images and attachments of pages to 'resources' directory and point pages to them "
+             '(use with -u)'
+    )
+    arg_parser.add_argument(
+        '--compression-level',
+        type=int,
+        choices=range(10),
+        default=6,
+        help='Zlib compression level of saved pages, 0 stores pages without compression (use with -u)'
+    )
+    arg_parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Save content of last downloaded page to page.txt (use with -u)'
+    )
+    arg_parser.add_argument(
+        '--incremental',
+        '-i',
+        action='store_true',
+        help='Download only sections and pages modified since last download (use with -u)'
+    )
 
-    return arg_parser.parse_args()
+    arg_parser.add_argument(
+        '--export',
+        metavar='DIR',
+        help='Export notebook to DIR, folder per section and file per page. '
+             'Only pages changed since last export to DIR are written again'
+    )
+    arg_parser.add_argument(
+        '--format',
+        choices=OneNoteOffline.EXPORT_FORMATS,
+        default='md',
+        help='Format of exported pages: Markdown, html or plain text (use with --export)'
+    )
+    arg_parser.add_argument(
+        '--interactive',
+        action='store_true',
+        help='Read queries (options like -t, -s, -f) one per line, with store opened only once'
+    )
+    arg_parser.add_argument(
+        '--serve',
+        metavar='SOCKET',
+        help='Answer queries of --connect clients on Unix socket, with store opened only once'
+    )
+    arg_parser.add_argument(
+        '--connect',
+        metavar='SOCKET',
+        help='Send query to server started with --serve, like: --connect onenote.sock -t title'
+    )
+    arg_parser.add_argument(
+        '--stats',
+        metavar='FILE',
+        nargs='?',
+        const='-',
+        help='Write timings of phases (auth, listings, content fetch, parse, store write or lookups of queries), '
+             'request latency histograms, bytes, retries and throttles as JSON to FILE (printed without FILE)'
+    )
+    arg_parser.add_argument(
+        '--profile',
+        metavar='FILE',
+        help='Save cProfile stats of main thread to FILE, show them with: python -m pstats FILE'
+    )
+
+    return arg_parser.parse_args(argv)
+
+
+def main(args):
+    '''Runs download or offline query and returns its stats'''
+    metrics = Metrics()
+    if args.connect:
+        with metrics.phase('query'):
+            print(query_server(args.connect, sys.argv[1:]), end='')
+        return metrics.summary()
+    if args.user:
+        with metrics.phase('open store'):
+            store = PageStore(compression_level=args.compression_level)
+        onenote = OneNoteDownload(
+            args.user,
+            workers=args.workers,
+            incremental=args.incremental,
+            store=store,
+            rate=args.rate,
+            debug=args.debug,
+            batch=args.batch,
+            notebook_listing=args.notebook_listing,
+            metrics=metrics,
+            resources=args.resources
+        )
+        onenote.download()
+        return onenote.stats()
+    onenote_offline = OneNoteOffline(metrics=metrics)
+    if args.export:
+        onenote_offline.export(args.export, args.format)
+    elif args.serve:
+        onenote_offline.serve(args.serve)
+    elif args.interactive:
+        onenote_offline.interactive()
+    else:
+        onenote_offline.display_notes(args)
+    return onenote_offline.stats()
 
 
 if __name__ == '__main__':
 
     args = parse_arguments()
 
-    if args.user:
-        started_at = time.monotonic()
-        onenote = OneNoteDownload(args.user)
-        onenote.download()
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        stats = profiler.runcall(main, args)
+        profiler.dump_stats(args.profile)
     else:
-        OneNoteOffline().display_notes(args)
+        stats = main(args)
+    if args.stats:
+        write_stats(stats, args.stats)
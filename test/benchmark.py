@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+'''Measures OneNoteDownload against local fake Graph server: wall time,
+number of requests, bytes sent by server, peak memory and total time of
+download phases. Prints one JSON line per run, so results can be
+compared between versions. Every run downloads in its own new process,
+so peak memory of one run does not include earlier runs.
+
+Example: ./benchmark.py --sections 20 --pages 50 --latency 0.05 --workers 1,4,8
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import tempfile
+import tracemalloc
+import multiprocessing
+import concurrent.futures
+from contextlib import redirect_stdout
+from unittest.mock import patch
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+from onenote import OneNoteDownload, PageStore
+from fake_graph import FakeGraphServer, FakeNotebook
+
+
+def run_download(server, workers, rate, incremental=False, directory=None, trace_memory=False, batch=False,
+                 notebook_listing=False, resources=False):
+    '''Downloads notebook from fake server into directory in new process
+    and returns measurements of the run
+    '''
+    server.reset_stats()
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        result = executor.submit(
+            measure_download, server.graph_url, workers, rate, incremental, directory, trace_memory, batch,
+            notebook_listing, resources
+        ).result()
+    result.update({
+        'requests': server.stats['requests'],
+        'requests_by_kind': dict(server.stats['paths']),
+        'bytes_sent': server.stats['bytes_sent'],
+        'throttled': server.stats['throttled'],
+        'errors': server.stats['errors'],
+    })
+    return result
+
+
+def measure_download(graph_url, workers, rate, incremental, directory, trace_memory, batch, notebook_listing,
+                     resources):
+    '''Downloads notebook and returns measurements, it is run in its own
+    process. Peak memory of the process and of its text extraction workers
+    is reported separately.
+    '''
+    previous_directory = os.getcwd()
+    os.chdir(directory)
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with patch.object(OneNoteDownload, 'get_access_token', return_value='token'), \
+                redirect_stdout(io.StringIO()):
+            started_at = time.perf_counter()
+            onenote = OneNoteDownload(
+                'bench@outlook.com',
+                workers=workers,
+                incremental=incremental,
+                store=PageStore('notes.db'),
+                rate=rate,
+                graph_url=graph_url,
+                batch=batch,
+                notebook_listing=notebook_listing,
+                resources=resources,
+            )
+            onenote.download()
+            seconds_taken = time.perf_counter() - started_at
+        result = {
+            'workers': workers,
+            'incremental': incremental,
+            'batch': batch,
+            'notebook_listing': notebook_listing,
+            'resources': resources,
+            'wall_seconds': round(seconds_taken, 3),
+            'pages_downloaded': onenote.pages_downloaded,
+            'resources_downloaded': onenote.resources_downloaded,
+            'pages_per_second': round(onenote.pages_downloaded / seconds_taken, 1),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'workers_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+            'phases_ms': {name: phase['total_ms'] for name, phase in onenote.stats()['phases'].items()},
+        }
+        if trace_memory:
+            result['python_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        onenote.store.connection.close()
+        return result
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        os.chdir(previous_directory)
+
+
+def parse_arguments():
+    arg_parser = argparse.ArgumentParser(description='Benchmark of notebook download against fake Graph server.')
+    arg_parser.add_argument('--sections', type=int, default=10)
+    arg_parser.add_argument('--pages', type=int, default=50, help='Pages per section')
+    arg_parser.add_argument('--page-size', type=int, default=8192, help='Page content size in bytes')
+    arg_parser.add_argument('--page-limit', type=int, default=20, help='Items per listing response')
+    arg_parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every response')
+    arg_parser.add_argument('--throttle-rate', type=float, default=0, help='Fraction of requests answered with 429')
+    arg_parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests answered with 500')
+    arg_parser.add_argument('--workers', default='1,4,8', help='Comma separated numbers of workers to compare')
+    arg_parser.add_argument('--rate', type=float, default=1000, help='Maximum requests per second of client')
+    arg_parser.add_argument('--incremental', action='store_true', help='Also measure incremental rerun')
+    arg_parser.add_argument('--batch', action='store_true', help='Fetch page contents with $batch requests')
+    arg_parser.add_argument('--notebook-listing', action='store_true', help='List pages with one notebook wide listing')
+    arg_parser.add_argument('--resources-per-page', type=int, default=0, help='Images per page (plus one shared)')
+    arg_parser.add_argument('--resources', action='store_true', help='Download images of pages')
+    arg_parser.add_argument('--trace-memory', action='store_true', help='Measure Python heap peak (slower)')
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    notebook = FakeNotebook(args.sections, args.pages, args.page_size, resources_per_page=args.resources_per_page)
+    fake_server = FakeGraphServer(
+        notebook,
+        page_limit=args.page_limit,
+        latency=args.latency,
+        throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate,
+    )
+    with fake_server:
+        for workers in [int(workers) for workers in args.workers.split(',')]:
+            with tempfile.TemporaryDirectory() as directory:
+                for incremental in [False, True] if args.incremental else [False]:
+                    result = run_download(
+                        fake_server, workers, args.rate, incremental, directory, args.trace_memory, args.batch,
+                        args.notebook_listing, args.resources
+                    )
+                    print(json.dumps(result))
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+'''Local stand-in for Microsoft Graph OneNote API, used by end to end
+tests and benchmark. Serves synthetic notebook of configurable size and
+can inject latency, throttling (429) and server errors (500).
+'''
+
+import base64
+import gzip
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+
+class FakeNotebook:
+    '''Synthetic notebook: sections with pages of page_size bytes, fraction
+    duplicate_rate of pages has identical content (like pages made from
+    a template). Every page can have resources_per_page own images and
+    one image shared by all pages, their URLs point to GRAPH_URL like in
+    Graph (server replaces it with its own URL).
+    '''
+    GRAPH_URL = 'https://graph.microsoft.com/v1.0'
+
+    def __init__(self, sections=3, pages_per_section=10, page_size=2048, seed=0, duplicate_rate=0,
+                 resources_per_page=0, resource_size=4096):
+        self.sections = []
+        self.pages = {}
+        self.contents = {}
+        self.resources = {}
+        resource_filler = random.Random(seed + 1)
+        filler = random.Random(seed)
+        words = ['cron', 'backup', 'linux', 'network', 'python', 'docker', 'notes', 'table', 'server', 'config']
+        template = self._make_content('Template', page_size, words, filler) if duplicate_rate else None
+        for section_number in range(sections):
+            section_id = f'section-{section_number}'
+            self.sections.append({
+                'id': section_id,
+                'displayName': f'SECTION {section_number}',
+                'lastModifiedDateTime': '2020-12-01T13:52:51Z',
+            })
+            self.pages[section_id] = []
+            for page_number in range(pages_per_section):
+                page_id = f'page-{section_number}-{page_number}'
+                title = f'Page {section_number}-{page_number}'
+                self.pages[section_id].append({
+                    'id': page_id,
+                    'title': title,
+                    'lastModifiedDateTime': '2020-11-25T16:08:18Z',
+                })
+                if duplicate_rate and filler.random() < duplicate_rate:
+                    self.contents[page_id] = template
+                else:
+                    self.contents[page_id] = self._make_content(title, page_size, words, filler)
+                if resources_per_page:
+                    resource_ids = ['resource-shared'] + [
+                        f'resource-{section_number}-{page_number}-{number}' for number in range(resources_per_page)
+                    ]
+                    for resource_id in resource_ids:
+                        if resource_id not in self.resources:
+                            self.resources[resource_id] = b'\x89PNG\r\n' + resource_filler.randbytes(resource_size)
+                    self.contents[page_id] = self.contents[page_id].replace('\t</body>', ''.join(
+                        f'\t\t<img src="{self.GRAPH_URL}/users/fake/onenote/resources/{resource_id}/$value" />\n'
+                        for resource_id in resource_ids
+                    ) + '\t</body>')
+
+    @staticmethod
+    def _make_content(title, page_size, words, filler):
+        head = (
+            f'<html lang="en-US">\n\t<head>\n\t\t<title>{title}</title>\n\t</head>\n'
+            '\t<body data-absolute-enabled="true" style="font-family:Calibri;font-size:11pt">\n'
+        )
+        tail = '\t</body>\n</html>\n'
+        paragraphs = []
+        size = len(head) + len(tail)
+        while size < page_size:
+            text = ' '.join(filler.choice(words) for _ in range(12))
+            paragraph = f'\t\t<p style="margin-top:0pt;margin-bottom:0pt">{text}</p>\n'
+            paragraphs.append(paragraph)
+            size += len(paragraph)
+        return head + ''.join(paragraphs) + tail
+
+    def touch_page(self, page_id, modified):
+        '''Marks page and its section as modified, like editing it'''
+        for section_id, pages in self.pages.items():
+            for page in pages:
+                if page['id'] == page_id:
+                    page['lastModifiedDateTime'] = modified
+                    self.contents[page_id] += f'<p>edited {modified}</p>'
+                    section = next(section for section in self.sections if section['id'] == section_id)
+                    section['lastModifiedDateTime'] = modified
+
+
+class FakeGraphServer:
+    '''HTTP server with OneNote endpoints of Graph:
+    /v1.0/users/{user}/onenote/sections, /sections/{id}/pages (both
+    paginated with @odata.nextLink), notebook wide /pages listing (with
+    $expand=parentSection), /pages/{id}/content, /resources/{id}/$value
+    and JSON batching endpoint /v1.0/$batch (failures are injected per
+    item). Listings support $select and $top (up to page_limit).
+    '''
+    def __init__(self, notebook=None, page_limit=20, latency=0, throttle_rate=0, error_rate=0, seed=0):
+        self.notebook = notebook or FakeNotebook()
+        self.page_limit = page_limit
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def graph_url(self):
+        host, port = self.httpd.server_address
+        return f'http://{host}:{port}/v1.0'
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'bytes_sent': 0, 'throttled': 0, 'errors': 0, 'paths': {}}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _record(self, path_kind, bytes_sent, is_request=True):
+        with self.lock:
+            if is_request:
+                self.stats['requests'] += 1
+            self.stats['bytes_sent'] += bytes_sent
+            self.stats['paths'][path_kind] = self.stats['paths'].get(path_kind, 0) + 1
+
+    def _draw_failure(self):
+        '''Returns 429, 500 or None, according to configured rates'''
+        with self.lock:
+            draw = self.random.random()
+            if draw < self.throttle_rate:
+                self.stats['throttled'] += 1
+                return 429
+            if draw < self.throttle_rate + self.error_rate:
+                self.stats['errors'] += 1
+                return 500
+        return None
+
+    def route(self, method, path, query, body):
+        '''Returns ((status, content type, body bytes), path kind)'''
+        if path == '/v1.0/$batch':
+            if method != 'POST':
+                return self._json_error(405, 'Method not allowed'), 'batch'
+            return self._batch(json.loads(body)), 'batch'
+        parts = path.strip('/').split('/')
+        # v1.0 / users / {user} / onenote / ...
+        if len(parts) < 5 or parts[:2] != ['v1.0', 'users'] or parts[3] != 'onenote':
+            return self._json_error(404, 'Not found'), 'other'
+        resource = parts[4:]
+        if method == 'GET' and resource == ['sections']:
+            return self._listing(self.notebook.sections, path, query), 'sections'
+        if method == 'GET' and resource == ['pages']:
+            pages = [
+                dict(page, parentSection={'id': section['id'], 'displayName': section['displayName']})
+                for section in self.notebook.sections
+                for page in self.notebook.pages[section['id']]
+            ]
+            return self._listing(pages, path, query), 'notebook_pages'
+        if method == 'GET' and len(resource) == 3 and resource[0] == 'sections' and resource[2] == 'pages':
+            pages = self.notebook.pages.get(resource[1])
+            if pages is None:
+                return self._json_error(404, 'Section not found'), 'pages'
+            return self._listing(pages, path, query), 'pages'
+        if method == 'GET' and len(resource) == 3 and resource[0] == 'pages' and resource[2] == 'content':
+            content = self.notebook.contents.get(resource[1])
+            if content is None:
+                return self._json_error(404, 'Page not found'), 'content'
+            content = content.replace(FakeNotebook.GRAPH_URL, self.graph_url)
+            return (200, 'text/html', content.encode()), 'content'
+        if method == 'GET' and len(resource) == 3 and resource[0] == 'resources' and resource[2] == '$value':
+            content = self.notebook.resources.get(resource[1])
+            if content is None:
+                return self._json_error(404, 'Resource not found'), 'resource'
+            return (200, 'image/png', content), 'resource'
+        return self._json_error(404, 'Not found'), 'other'
+
+    def _listing(self, items, path, query):
+        skip = int(query.get('$skip', ['0'])[0])
+        top = min(int(query.get('$top', [str(self.page_limit)])[0]), self.page_limit)
+        values = items[skip:skip + top]
+        if '$select' in query:
+            fields = query['$select'][0].split(',')
+            if 'parentSection' in query.get('$expand', [''])[0]:
+                fields.append('parentSection')
+            values = [{field: item[field] for field in fields if field in item} for item in values]
+        response = {'value': values}
+        if skip + top < len(items):
+            next_query = dict((key, values[0]) for key, values in query.items())
+            next_query['$skip'] = str(skip + top)
+            response['@odata.nextLink'] = f'{self.graph_url.rsplit("/v1.0", 1)[0]}{path}?{urlencode(next_query)}'
+        return 200, 'application/json', json.dumps(response).encode()
+
+    def _batch(self, batch_request):
+        '''Answers every request of batch, bodies which are not JSON are
+        base64 encoded like in Graph
+        '''
+        requests = batch_request.get('requests', [])
+        if len(requests) > 20:
+            return self._json_error(400, 'Maximum 20 requests in batch')
+        responses = []
+        for request in requests:
+            url = urlsplit(request['url'])
+            failure = self._draw_failure()
+            headers = {}
+            if failure == 429:
+                (status, content_type, payload), path_kind = self._json_error(429, 'Too many requests'), 'throttled'
+                headers['Retry-After'] = '0'
+            elif failure == 500:
+                (status, content_type, payload), path_kind = self._json_error(500, 'Server error'), 'error'
+            else:
+                (status, content_type, payload), path_kind = self.route(
+                    request.get('method', 'GET'), '/v1.0/' + url.path.lstrip('/'), parse_qs(url.query), b''
+                )
+            self._record(f'batch_{path_kind}', 0, is_request=False)
+            headers['Content-Type'] = content_type
+            if content_type == 'application/json':
+                body = json.loads(payload)
+            else:
+                body = base64.b64encode(payload).decode()
+            responses.append({'id': request['id'], 'status': status, 'headers': headers, 'body': body})
+        return 200, 'application/json', json.dumps({'responses': responses}).encode()
+
+    @staticmethod
+    def _json_error(status, message):
+        return status, 'application/json', json.dumps({'error': {'code': str(status), 'message': message}}).encode()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def _handle(self, method):
+                url = urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if server.latency:
+                    time.sleep(server.latency)
+                failure = server._draw_failure()
+                if failure == 429:
+                    (status, content_type, payload), path_kind = server._json_error(429, 'Too many requests'), 'throttled'
+                    extra_headers = {'Retry-After': '0'}
+                elif failure == 500:
+                    (status, content_type, payload), path_kind = server._json_error(500, 'Server error'), 'error'
+                    extra_headers = {}
+                else:
+                    (status, content_type, payload), path_kind = server.route(
+                        method, url.path, parse_qs(url.query), body
+                    )
+                    extra_headers = {}
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    payload = gzip.compress(payload, compresslevel=1)
+                    extra_headers['Content-Encoding'] = 'gzip'
+                server._record(path_kind, len(payload))
+
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                for header, value in extra_headers.items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(description='Serves synthetic notebook with fake Graph OneNote API.')
+    arg_parser.add_argument('--sections', type=int, default=3)
+    arg_parser.add_argument('--pages', type=int, default=10, help='Pages per section')
+    arg_parser.add_argument('--page-size', type=int, default=2048)
+    arg_parser.add_argument('--latency', type=float, default=0)
+    arg_parser.add_argument('--throttle-rate', type=float, default=0)
+    arg_parser.add_argument('--error-rate', type=float, default=0)
+    args = arg_parser.parse_args()
+
+    fake_server = FakeGraphServer(
+        FakeNotebook(args.sections, args.pages, args.page_size),
+        latency=args.latency,
+        throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate,
+    )
+    print(f'Serving on {fake_server.graph_url}')
+    try:
+        fake_server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        fake_server.httpd.server_close()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+'''Measures PageStore with synthetic notebook: size of database file,
+time of saving all pages, latency of reading them back with a new
+connection and of title lookups (exact, with a typo and by 2 characters),
+for uncompressed pages and given compression levels. Prints one JSON line
+per compression level, and one for title lookups in a store with many
+small pages.
+
+Example: ./store_benchmark.py --sections 20 --pages 50 --duplicate-rate 0.2 --levels none,1,6,9 --title-pages 200000
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import tempfile
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+from onenote import PageStore, extract_text
+from fake_graph import FakeNotebook
+
+
+def run_store(notebook, texts, compression_level, directory):
+    '''Saves notebook pages to new store in directory, reads them back and
+    returns measurements of the run
+    '''
+    path = os.path.join(directory, f'notes-{compression_level}.db')
+    store = PageStore(path, shelve_path=None, compression_level=compression_level)
+    started_at = time.perf_counter()
+    for section_position, section in enumerate(notebook.sections):
+        pages = notebook.pages[section['id']]
+        for position, page in enumerate(pages):
+            store.put_page(
+                section['displayName'], page['title'], page['id'], page['lastModifiedDateTime'],
+                notebook.contents[page['id']], position, texts[page['id']]
+            )
+        store.put_section(
+            section['displayName'], section['id'], section['lastModifiedDateTime'], section_position,
+            [page['id'] for page in pages]
+        )
+    write_seconds = time.perf_counter() - started_at
+    store.connection.close()
+
+    store = PageStore(path, shelve_path=None, compression_level=compression_level)
+    latencies = []
+    for section_name, section_notes in store.notes().items():
+        for title in section_notes:
+            started_at = time.perf_counter()
+            store.get_html(section_name, title)
+            latencies.append(time.perf_counter() - started_at)
+    lookup_latencies = measure_lookups(store, [page['title'] for pages in notebook.pages.values() for page in pages])
+    store.connection.close()
+    return {
+        'compression_level': compression_level,
+        'pages': len(latencies),
+        'html_bytes': sum(len(content.encode()) for content in notebook.contents.values()),
+        'store_bytes': os.path.getsize(path),
+        'write_seconds': round(write_seconds, 3),
+        'read_seconds': round(sum(latencies), 3),
+        'read_ms_median': round(statistics.median(latencies) * 1000, 3),
+        'read_ms_max': round(max(latencies) * 1000, 3),
+        **lookup_medians(lookup_latencies),
+    }
+
+
+def run_titles(page_count, directory):
+    '''Saves page_count small pages to new store in directory and returns
+    measurements of title lookups
+    '''
+    notebook = FakeNotebook(max(page_count // 1000, 1), min(page_count, 1000), page_size=0)
+    path = os.path.join(directory, 'notes-titles.db')
+    store = PageStore(path, shelve_path=None)
+    started_at = time.perf_counter()
+    for section_position, section in enumerate(notebook.sections):
+        pages = notebook.pages[section['id']]
+        for position, page in enumerate(pages):
+            store.put_page(
+                section['displayName'], page['title'], page['id'], page['lastModifiedDateTime'],
+                notebook.contents[page['id']], position, page['title']
+            )
+        store.put_section(
+            section['displayName'], section['id'], section['lastModifiedDateTime'], section_position,
+            [page['id'] for page in pages]
+        )
+    write_seconds = time.perf_counter() - started_at
+    lookup_latencies = measure_lookups(store, [page['title'] for pages in notebook.pages.values() for page in pages])
+    store.connection.close()
+    return {
+        'title_pages': sum(len(pages) for pages in notebook.pages.values()),
+        'write_seconds': round(write_seconds, 3),
+        **lookup_medians(lookup_latencies),
+    }
+
+
+def measure_lookups(store, titles, samples=100):
+    '''Returns latencies of find_titles for sample of titles, as they are,
+    with two characters swapped and by their last two characters
+    '''
+    latencies = {'exact': [], 'typo': [], 'short': []}
+    for title in titles[::max(len(titles) // samples, 1)]:
+        middle = len(title) // 2
+        typo = title[:middle - 1] + title[middle] + title[middle - 1] + title[middle + 1:]
+        for kind, keyword in (('exact', title), ('typo', typo), ('short', title[-2:])):
+            started_at = time.perf_counter()
+            store.find_titles(keyword)
+            latencies[kind].append(time.perf_counter() - started_at)
+    return latencies
+
+
+def lookup_medians(latencies):
+    return {
+        'lookup_ms_median': round(statistics.median(latencies['exact']) * 1000, 3),
+        'typo_lookup_ms_median': round(statistics.median(latencies['typo']) * 1000, 3),
+        'short_lookup_ms_median': round(statistics.median(latencies['short']) * 1000, 3),
+    }
+
+
+def parse_arguments():
+    arg_parser = argparse.ArgumentParser(description='Benchmark of page store size and read latency.')
+    arg_parser.add_argument('--sections', type=int, default=10)
+    arg_parser.add_argument('--pages', type=int, default=50, help='Pages per section')
+    arg_parser.add_argument('--page-size', type=int, default=8192, help='Page content size in bytes')
+    arg_parser.add_argument('--duplicate-rate', type=float, default=0.1, help='Fraction of identical pages')
+    arg_parser.add_argument(
+        '--levels', default='none,1,6,9', help='Comma separated compression levels, none for uncompressed store'
+    )
+    arg_parser.add_argument(
+        '--title-pages', type=int, default=100000, help='Pages of store with many titles, 0 to skip title lookups'
+    )
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    notebook = FakeNotebook(args.sections, args.pages, args.page_size, duplicate_rate=args.duplicate_rate)
+    texts = {page_id: extract_text(content) for page_id, content in notebook.contents.items()}
+    with tempfile.TemporaryDirectory() as directory:
+        for level in args.levels.split(','):
+            result = run_store(notebook, texts, None if level == 'none' else int(level), directory)
+            print(json.dumps(result))
+        if args.title_pages:
+            print(json.dumps(run_titles(args.title_pages, directory)))
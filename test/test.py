@@ -2,8 +2,16 @@
 
 import sys
 import io
+import tempfile
 import shelve
+import sqlite3
+import re
+import json
+import shutil
+import pstats
 import logging
+import subprocess
+import threading
 import unittest
 from unittest.mock import patch
 from unittest import mock
@@ -11,15 +19,26 @@ import os.path
 sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
 )
-from onenote import OneNoteDownload, OneNoteOffline
+import requests as onenote_requests
+from onenote import OneNoteDownload, OneNoteOffline, PageStore, GraphClient, Metrics, query_server
+from fake_graph import FakeGraphServer, FakeNotebook
 
 logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 log = logging.getLogger("TestLog")
 
 
+def mock_response(text, status_code=200, headers=None):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.ok = status_code < 400
+    response.headers = headers or {}
+    response.iter_content.side_effect = lambda chunk_size: iter([text.encode()])
+    return response
+
+
 class TestOneNoteDownload(unittest.TestCase):
 
-    @patch('onenote.requests.get')
+    @patch('onenote.requests.Session.get')
     @patch('onenote.OneNoteDownload.get_access_token')
     def test_get_sections_data(self,
                                get_access_token_mock,
@@ -29,28 +48,28 @@ class TestOneNoteDownload(unittest.TestCase):
         with open('sections_list_response_fixture_part2.txt') as f:
             sections_fixture_part2 = f.read()
 
-        mockresponse1 = mock.Mock()
-        mockresponse1.text = sections_fixture_part1
-        mockresponse2 = mock.Mock()
-        mockresponse2.text = sections_fixture_part2
+        mockresponse1 = mock_response(sections_fixture_part1)
+        mockresponse2 = mock_response(sections_fixture_part2)
         requests_get_mock.side_effect = [
             mockresponse1,
-            mockresponse1,
-            mockresponse2,
             mockresponse2
         ]
 
         onenote = OneNoteDownload('test@outlook.com')
 
-        requests_get_mock.assert_called_with(
-            'https://load_part_2',
-            headers={'Authorization': str(get_access_token_mock())}
+        self.assertEqual(requests_get_mock.call_count, 2)
+        self.assertEqual(
+            requests_get_mock.call_args_list[0][0][0],
+            'https://graph.microsoft.com/v1.0/users/test@outlook.com/onenote/sections'
+            '?$select=id,displayName,lastModifiedDateTime&$top=100'
         )
+        requests_get_mock.assert_called_with('https://load_part_2', timeout=60, stream=True)
+        self.assertEqual(onenote.client.session.headers['Authorization'], str(get_access_token_mock()))
         for section_number in range(1, 7):
             assert(onenote.section_data.get(f'SECTION NAME {section_number}'))
 
     @patch('onenote.OneNoteDownload._get_sections_data')
-    @patch('onenote.requests.get')
+    @patch('onenote.requests.Session.get')
     @patch('onenote.OneNoteDownload.get_access_token')
     def test_get_pages(self,
                        get_access_token_mock,
@@ -66,14 +85,10 @@ class TestOneNoteDownload(unittest.TestCase):
         with open('pages_list_response_fixture_part2.txt') as f:
             pages_fixture2 = f.read()
 
-        mockresponse1 = mock.Mock()
-        mockresponse1.text = pages_fixture1
-        mockresponse2 = mock.Mock()
-        mockresponse2.text = pages_fixture2
+        mockresponse1 = mock_response(pages_fixture1)
+        mockresponse2 = mock_response(pages_fixture2)
         requests_get_mock.side_effect = [
             mockresponse1,
-            mockresponse1,
-            mockresponse2,
             mockresponse2
         ]
 
@@ -88,13 +103,37 @@ class TestOneNoteDownload(unittest.TestCase):
 
         pages = onenote.get_pages('SECTION NAME 1')
         self.assertEqual(pages, pages_expected_value)
-        requests_get_mock.assert_called_with(
-            'https://load_part_2',
-            headers={'Authorization': str(get_access_token_mock())}
-        )
+        self.assertEqual(requests_get_mock.call_count, 2)
+        requests_get_mock.assert_called_with('https://load_part_2', timeout=60, stream=True)
+        self.assertEqual(onenote.client.session.headers['Authorization'], str(get_access_token_mock()))
+
+    @patch('onenote.time.sleep')
+    @patch('onenote.OneNoteDownload._get_sections_data')
+    @patch('onenote.requests.Session.get')
+    @patch('onenote.OneNoteDownload.get_access_token')
+    def test_iter_link_values_retries_failed_page(self,
+                                                  get_access_token_mock,
+                                                  requests_get_mock,
+                                                  get_sections_data_mock,
+                                                  sleep_mock):
+        onenote = OneNoteDownload('test@outlook.com')
+
+        error_response = mock_response('{"error": {"code": "20166", "message": "Too many requests"}}')
+        page1_response = mock_response('{"value": [1, 2], "@odata.nextLink": "https://load_part_2"}')
+        page2_response = mock_response('{"value": [3]}')
+        requests_get_mock.side_effect = [error_response, page1_response, page2_response]
+
+        with patch('sys.stdout', new_callable=io.StringIO):
+            values = onenote._iter_link_values('https://load_part_1')
+            self.assertEqual(next(values), 1)
+            self.assertEqual(requests_get_mock.call_count, 2)
+            self.assertEqual(list(values), [2, 3])
+        self.assertEqual(requests_get_mock.call_count, 3)
+        sleep_mock.assert_called_once()
+        self.assertTrue(1 <= sleep_mock.call_args.args[0] <= 2)
 
     @patch('onenote.OneNoteDownload._get_sections_data')
-    @patch('onenote.requests.get')
+    @patch('onenote.requests.Session.get')
     @patch('onenote.OneNoteDownload.get_access_token')
     def test_get_note_text(self,
                            get_access_token_mock,
@@ -102,8 +141,7 @@ class TestOneNoteDownload(unittest.TestCase):
                            get_sections_data_mock):
         with open('page_response_fixture.txt') as f:
             page_fixture = f.read()
-        mockresponse = mock.Mock()
-        mockresponse.text = page_fixture
+        mockresponse = mock_response(page_fixture)
         requests_get_mock.return_value = mockresponse
 
         onenote = OneNoteDownload('test@outlook.com')
@@ -111,23 +149,696 @@ class TestOneNoteDownload(unittest.TestCase):
         expected_note_text = \
         '\n\nPage title\n\n\n\n\n\nHeader\n\nNote text\n\n\n\n\n'
 
-        note_text = onenote.get_note_text('test_id')
+        with patch('onenote.open', mock.mock_open(), create=True) as open_mock:
+            note_text = onenote.get_note_text('test_id')
         self.assertEqual(note_text, expected_note_text)
+        open_mock.assert_not_called()
+        self.assertEqual(onenote.client.bytes_received, len(page_fixture.encode()))
+
+    @patch('onenote.OneNoteDownload.get_note_html')
+    @patch('onenote.OneNoteDownload.iter_pages_data')
+    @patch('onenote.OneNoteDownload._get_sections_data')
+    @patch('onenote.OneNoteDownload.get_access_token')
+    def test_download(self,
+                      get_access_token_mock,
+                      get_sections_data_mock,
+                      iter_pages_data_mock,
+                      get_note_html_mock):
+        get_sections_data_mock.return_value = {
+            'SECTION NAME 1': {'id': 'section 1 id', 'lastModifiedDateTime': '2020-12-01T13:52:51Z'},
+            'SECTION NAME 2': {'id': 'section 2 id', 'lastModifiedDateTime': '2020-12-01T13:52:51Z'},
+        }
+        iter_pages_data_mock.side_effect = lambda section_name: iter([
+            {
+                'title': f'{section_name} title{number}',
+                'id': f'{section_name} page{number}_id',
+                'lastModifiedDateTime': '2020-11-25T16:08:18Z'
+            }
+            for number in range(10)
+        ])
+        get_note_html_mock.side_effect = lambda page_id: f'<p>{page_id}</p>'
+        store = PageStore(':memory:')
+
+        onenote = OneNoteDownload('test@outlook.com', workers=3, store=store)
+        with patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
+            onenote.download()
+
+        lib = store.notes()
+        self.assertEqual(list(lib), ['SECTION NAME 1', 'SECTION NAME 2'])
+        for section_name, section_notes in lib.items():
+            self.assertEqual(
+                list(section_notes),
+                [f'{section_name} title{number}' for number in range(10)]
+            )
+            self.assertEqual(
+                section_notes[f'{section_name} title3'],
+                f'<p>{section_name} page3_id</p>'
+            )
+            self.assertEqual(
+                store.get_text(section_name, f'{section_name} title3'),
+                f'{section_name} page3_id'
+            )
+        self.assertEqual(
+            store.get_page_states('SECTION NAME 1')['SECTION NAME 1 page3_id'],
+            '2020-11-25T16:08:18Z'
+        )
+        self.assertEqual(
+            store.get_section_state('SECTION NAME 2'),
+            ('section 2 id', '2020-12-01T13:52:51Z')
+        )
+        self.assertEqual(onenote.pages_downloaded, 20)
+        self.assertIn('Downloaded 20 pages', mock_stdout.getvalue())
+
+    @patch('onenote.OneNoteDownload.get_note_html')
+    @patch('onenote.OneNoteDownload.iter_pages_data')
+    @patch('onenote.OneNoteDownload._get_sections_data')
+    @patch('onenote.OneNoteDownload.get_access_token')
+    def test_download_incremental(self,
+                                  get_access_token_mock,
+                                  get_sections_data_mock,
+                                  iter_pages_data_mock,
+                                  get_note_html_mock):
+        old_date = '2020-11-25T16:08:18Z'
+        new_date = '2020-12-01T13:52:51Z'
+        get_sections_data_mock.return_value = {
+            'UNCHANGED': {'id': 'unchanged id', 'lastModifiedDateTime': old_date},
+            'CHANGED': {'id': 'changed id', 'lastModifiedDateTime': new_date},
+        }
+        iter_pages_data_mock.return_value = iter([
+            {'title': 'unchanged title', 'id': 'unchanged page id', 'lastModifiedDateTime': old_date},
+            {'title': 'changed title', 'id': 'changed page id', 'lastModifiedDateTime': new_date},
+            {'title': 'new title', 'id': 'new page id', 'lastModifiedDateTime': new_date},
+        ])
+        get_note_html_mock.side_effect = lambda page_id: f'<p>{page_id} downloaded</p>'
+        store = PageStore(':memory:')
+        store.put_page('UNCHANGED', 'title', 'page id', old_date, '<p>unchanged section page</p>', 0)
+        store.put_section('UNCHANGED', 'unchanged id', old_date, 0, ['page id'])
+        for position, title in enumerate(['unchanged title', 'changed title', 'deleted title']):
+            store.put_page('CHANGED', title, title.replace('title', 'page id'), old_date, '<p>stored</p>', position)
+        store.put_section(
+            'CHANGED', 'changed id', old_date, 1, ['unchanged page id', 'changed page id', 'deleted page id']
+        )
+        store.put_page('DELETED', 'title', 'page id', old_date, '<p>deleted section page</p>', 0)
+        store.put_section('DELETED', 'deleted id', old_date, 2, ['page id'])
+
+        onenote = OneNoteDownload('test@outlook.com', workers=2, incremental=True, store=store)
+        with patch('sys.stdout', new_callable=io.StringIO):
+            onenote.download()
+
+        iter_pages_data_mock.assert_called_once_with('CHANGED')
+        self.assertEqual(
+            sorted(call.args[0] for call in get_note_html_mock.call_args_list),
+            ['changed page id', 'new page id']
+        )
+        self.assertEqual(store.notes(), {
+            'UNCHANGED': {'title': '<p>unchanged section page</p>'},
+            'CHANGED': {
+                'unchanged title': '<p>stored</p>',
+                'changed title': '<p>changed page id downloaded</p>',
+                'new title': '<p>new page id downloaded</p>',
+            },
+        })
+        self.assertIsNone(store.get_section_state('DELETED'))
+        self.assertEqual(store.get_section_state('CHANGED'), ('changed id', new_date))
+        self.assertEqual(onenote.pages_unchanged, 1)
+
+    @patch('onenote.OneNoteDownload.get_note_html')
+    @patch('onenote.OneNoteDownload.iter_pages_data')
+    @patch('onenote.OneNoteDownload._get_sections_data')
+    @patch('onenote.OneNoteDownload.get_access_token')
+    def test_download_resumes_interrupted_download(self,
+                                                   get_access_token_mock,
+                                                   get_sections_data_mock,
+                                                   iter_pages_data_mock,
+                                                   get_note_html_mock):
+        get_sections_data_mock.return_value = {
+            'SECTION NAME 1': {'id': 'section 1 id', 'lastModifiedDateTime': '2020-12-01T13:52:51Z'},
+            'SECTION NAME 2': {'id': 'section 2 id', 'lastModifiedDateTime': '2020-12-01T13:52:51Z'},
+        }
+        iter_pages_data_mock.side_effect = lambda section_name: iter([
+            {
+                'title': f'{section_name} title{number}',
+                'id': f'{section_name} page{number}_id',
+                'lastModifiedDateTime': '2020-11-25T16:08:18Z'
+            }
+            for number in range(5)
+        ])
+
+        def get_note_html_interrupted(page_id):
+            if page_id == 'SECTION NAME 2 page2_id':
+                raise KeyboardInterrupt
+            return f'<p>{page_id}</p>'
+        get_note_html_mock.side_effect = get_note_html_interrupted
+        store = PageStore(':memory:')
+
+        onenote = OneNoteDownload('test@outlook.com', workers=1, store=store)
+        with patch('sys.stdout', new_callable=io.StringIO):
+            with self.assertRaises(KeyboardInterrupt):
+                onenote.download()
+        self.assertTrue(store.has_checkpoint())
+        self.assertEqual(
+            store.get_checkpoint_section('SECTION NAME 1'),
+            ('section 1 id', '2020-12-01T13:52:51Z')
+        )
+
+        get_note_html_mock.reset_mock()
+        get_note_html_mock.side_effect = lambda page_id: f'<p>{page_id}</p>'
+        with patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
+            onenote.download()
+
+        self.assertIn('Resuming interrupted download.', mock_stdout.getvalue())
+        self.assertIn('Section already downloaded: SECTION NAME 1', mock_stdout.getvalue())
+        self.assertEqual(
+            [call.args[0] for call in get_note_html_mock.call_args_list],
+            ['SECTION NAME 2 page2_id', 'SECTION NAME 2 page3_id', 'SECTION NAME 2 page4_id']
+        )
+        self.assertEqual(onenote.pages_resumed, 2)
+        self.assertEqual(list(store.notes()['SECTION NAME 2']), [f'SECTION NAME 2 title{number}' for number in range(5)])
+        self.assertFalse(store.has_checkpoint())
+
+    @patch('onenote.OneNoteDownload._get_sections_data')
+    @patch('onenote.OneNoteDownload.get_access_token')
+    def test_refresh_access_token(self, get_access_token_mock, get_sections_data_mock):
+        onenote = OneNoteDownload('test@outlook.com')
+        with self.assertRaises(RuntimeError):
+            onenote.refresh_access_token()
+
+        onenote.app = mock.Mock()
+        onenote.account = {'username': 'test@outlook.com'}
+        onenote.app.acquire_token_silent.return_value = {'access_token': 'new token'}
+        self.assertEqual(onenote.refresh_access_token(), 'new token')
+        onenote.app.acquire_token_silent.assert_called_with(
+            ['Notes.Read'], account={'username': 'test@outlook.com'}, force_refresh=True
+        )
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_summary(self):
+        metrics = Metrics()
+        metrics.record('store write', 0.0005)
+        metrics.record('store write', 0.015)
+        metrics.record('store write', 12)
+        with metrics.phase('parse'):
+            pass
+
+        summary = metrics.summary()
+        self.assertEqual(summary['phases']['store write']['count'], 3)
+        self.assertEqual(summary['phases']['store write']['max_ms'], 12000)
+        self.assertEqual(summary['phases']['store write']['histogram_ms'], {'<=1': 1, '<=20': 1, '>10000': 1})
+        self.assertEqual(summary['phases']['parse']['count'], 1)
+        self.assertEqual(Metrics.histogram([0.3, 0.003, 0.004]), {'<=5': 2, '<=500': 1})
+        json.dumps(summary)
+
+
+class TestGraphClient(unittest.TestCase):
+
+    @staticmethod
+    def _response(status_code, text='', headers=None):
+        return mock_response(text, status_code, headers)
+
+    @patch('onenote.TokenBucket.acquire')
+    @patch('onenote.time.sleep')
+    @patch('onenote.requests.Session.get')
+    def test_get_retries_throttled_request(self, session_get_mock, sleep_mock, acquire_mock):
+        session_get_mock.side_effect = [
+            self._response(429, headers={'Retry-After': '7'}),
+            self._response(503),
+            self._response(200, 'page'),
+        ]
+        client = GraphClient({'Authorization': 'token'}, rate=8)
+
+        response = client.get('https://page')
+
+        self.assertEqual(client.read_content(response), b'page')
+        self.assertEqual(session_get_mock.call_count, 3)
+        self.assertEqual(sleep_mock.call_args_list[0].args[0], 7)
+        self.assertEqual(acquire_mock.call_count, 3)
+        self.assertLess(client.rate_limiter.rate, 8)
+        self.assertEqual(client.session.headers['Accept-Encoding'], 'gzip, deflate')
+        stats = client.stats()
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['throttled'], 2)
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual(stats['bytes_received'], 4)
+
+    @patch('onenote.time.sleep')
+    @patch('onenote.requests.Session.get')
+    def test_get_returns_last_response_after_attempts(self, session_get_mock, sleep_mock):
+        session_get_mock.side_effect = [
+            onenote_requests.ConnectionError('connection reset'),
+            self._response(500),
+            self._response(500),
+        ]
+        client = GraphClient({}, attempts=3)
+
+        response = client.get('https://page')
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(sleep_mock.call_count, 2)
+        for attempt, sleep_call in enumerate(sleep_mock.call_args_list):
+            self.assertTrue(2 ** attempt / 2 <= sleep_call.args[0] <= 2 ** attempt)
+
+    @patch('onenote.requests.Session.get')
+    def test_get_refreshes_expired_token(self, session_get_mock):
+        session_get_mock.side_effect = [
+            self._response(401),
+            self._response(200, 'page'),
+        ]
+        refresh_authorization_mock = mock.Mock(return_value='new token')
+        client = GraphClient({'Authorization': 'old token'}, refresh_authorization=refresh_authorization_mock)
+
+        response = client.get('https://page')
+
+        self.assertEqual(response.status_code, 200)
+        refresh_authorization_mock.assert_called_once_with()
+        self.assertEqual(client.session.headers['Authorization'], 'new token')
+        client._refresh_authorization('old token')
+        refresh_authorization_mock.assert_called_once_with()
+
+    @patch('onenote.TokenBucket.acquire')
+    @patch('onenote.time.sleep')
+    @patch('onenote.requests.Session.post')
+    def test_batch_get_slows_down_once_per_batch(self, session_post_mock, sleep_mock, acquire_mock):
+        urls = [f'/pages/{number}/content' for number in range(20)]
+        session_post_mock.side_effect = [
+            self._response(200, json.dumps({'responses': [
+                {'id': str(index), 'status': 429, 'headers': {'Retry-After': str(index % 3)}}
+                for index in range(20)
+            ]})),
+            self._response(200, json.dumps({'responses': [
+                {'id': str(index), 'status': 200, 'headers': {'Content-Type': 'application/json'}, 'body': {}}
+                for index in range(20)
+            ]})),
+        ]
+        client = GraphClient({}, rate=10)
+
+        results = client.batch_get('https://graph/$batch', urls)
+
+        self.assertEqual([status for status, content in results], [200] * 20)
+        self.assertEqual([acquire_call.args[0] for acquire_call in acquire_mock.call_args_list], [20, 20])
+        self.assertEqual(client.stats()['throttled'], 1)
+        self.assertEqual(sleep_mock.call_args_list[0].args[0], 2)
+        self.assertEqual(client.rate_limiter.rate, 10 / 2 + 10 / 50)
+
+
+class TestOneNoteDownloadFakeGraph(unittest.TestCase):
+    '''Downloads synthetic notebook from local fake Graph server'''
+
+    def setUp(self):
+        self.notebook = FakeNotebook(sections=3, pages_per_section=7, page_size=1024)
+        self.server = FakeGraphServer(self.notebook, page_limit=3, throttle_rate=0.1, error_rate=0.05).start()
+        self.addCleanup(self.server.stop)
+        self.store = PageStore(':memory:')
+
+    def _download(self, incremental=False, batch=False, notebook_listing=False, resource_dir=None):
+        with patch('onenote.OneNoteDownload.get_access_token', return_value='token'), \
+                patch('onenote.GraphClient.backoff', return_value=0), \
+                patch('sys.stdout', new_callable=io.StringIO):
+            onenote = OneNoteDownload(
+                'test@outlook.com',
+                workers=4,
+                incremental=incremental,
+                store=self.store,
+                rate=1000,
+                graph_url=self.server.graph_url,
+                batch=batch,
+                notebook_listing=notebook_listing,
+                resources=resource_dir is not None,
+                resource_dir=resource_dir
+            )
+            onenote.download()
+        return onenote
+
+    def test_download(self):
+        onenote = self._download()
+
+        notes = self.store.notes()
+        self.assertEqual(list(notes), ['SECTION 0', 'SECTION 1', 'SECTION 2'])
+        self.assertEqual(list(notes['SECTION 1']), [f'Page 1-{number}' for number in range(7)])
+        self.assertEqual(notes['SECTION 2']['Page 2-5'], self.notebook.contents['page-2-5'])
+        self.assertEqual(onenote.pages_downloaded, 21)
+        self.assertEqual(self.server.stats['paths']['content'], 21)
+        self.assertEqual(self.server.stats['paths']['pages'], 9)
+
+    def test_download_batch(self):
+        self.notebook = FakeNotebook(sections=3, pages_per_section=15, page_size=1024)
+        self.server.notebook = self.notebook
+
+        onenote = self._download(batch=True)
+
+        notes = self.store.notes()
+        self.assertEqual(list(notes['SECTION 2']), [f'Page 2-{number}' for number in range(15)])
+        self.assertEqual(notes['SECTION 1']['Page 1-14'], self.notebook.contents['page-1-14'])
+        self.assertEqual(onenote.pages_downloaded, 45)
+        self.assertNotIn('content', self.server.stats['paths'])
+        self.assertEqual(self.server.stats['paths']['batch_content'], 45)
+        self.assertGreater(self.server.stats['paths']['batch_throttled'], 0)
+        self.assertLess(self.server.stats['paths']['batch'], 10)
+
+    def test_download_incremental(self):
+        self._download()
+        self.notebook.touch_page('page-1-3', '2021-01-01T10:00:00Z')
+        self.server.reset_stats()
+
+        onenote = self._download(incremental=True)
+
+        self.assertEqual(onenote.pages_downloaded, 1)
+        self.assertEqual(self.server.stats['paths']['content'], 1)
+        self.assertEqual(self.server.stats['paths']['pages'], 3)
+        self.assertIn('edited', self.store.get_text('SECTION 1', 'Page 1-3'))
+
+    def test_download_incremental_pages_with_the_same_title(self):
+        for page in self.notebook.pages['section-1']:
+            page['title'] = 'Untitled Page'
+        self._download()
+        self.assertEqual(self.store.titles('SECTION 1'), ['Untitled Page'] * 7)
+
+        for page_id, modified in [('page-1-3', '2021-01-01T10:00:00Z'), ('page-1-5', '2021-01-02T10:00:00Z')]:
+            self.notebook.touch_page(page_id, modified)
+            onenote = self._download(incremental=True)
+            self.assertEqual(onenote.pages_downloaded, 1)
+            self.assertEqual(onenote.pages_unchanged, 6)
+        self.assertEqual(len(self.store.get_page_states('SECTION 1')), 7)
+        self.assertIn('edited', self.store.get_text('SECTION 1', 'Untitled Page', 'page-1-3'))
+
+    def test_download_skips_failed_page(self):
+        content = self.notebook.contents.pop('page-1-3')
+
+        onenote = self._download(incremental=True)
+
+        self.assertEqual(onenote.stats()['pages']['failed'], 1)
+        self.assertEqual(onenote.pages_downloaded, 20)
+        with patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
+            onenote._print_throughput(1)
+        self.assertIn('1 pages failed', mock_stdout.getvalue())
+        self.assertNotIn('Page 1-3', self.store.titles('SECTION 1'))
+        self.assertEqual(self.store.get_section_state('SECTION 1'), ('section-1', None))
+        self.assertFalse(self.store.has_checkpoint())
+
+        self.notebook.contents['page-1-3'] = content
+        onenote = self._download(incremental=True)
+
+        self.assertEqual(onenote.pages_downloaded, 1)
+        self.assertEqual(onenote.pages_failed, 0)
+        self.assertIn('Page 1-3', self.store.titles('SECTION 1'))
+        self.assertEqual(self.store.get_section_state('SECTION 1'), ('section-1', '2020-12-01T13:52:51Z'))
+
+    def test_download_stats(self):
+        onenote = self._download()
+
+        stats = onenote.stats()
+        for phase in ['auth', 'section listing', 'page listing', 'content fetch', 'parse', 'store write']:
+            self.assertIn(phase, stats['phases'])
+        self.assertEqual(stats['phases']['content fetch']['count'], 21)
+        self.assertEqual(stats['phases']['store write']['count'], 21)
+        self.assertEqual(stats['phases']['section write']['count'], 3)
+        self.assertEqual(stats['pages']['downloaded'], 21)
+        self.assertEqual(sum(stats['requests']['latency_histogram_ms'].values()), stats['requests']['requests'])
+        self.assertGreater(stats['requests']['retries'], 0)
+        self.assertGreater(stats['bytes_downloaded'], 21 * 1024)
+
+    def test_download_resources(self):
+        self.notebook = FakeNotebook(sections=2, pages_per_section=5, page_size=1024, resources_per_page=2)
+        outside_url = self.server.graph_url.replace('127.0.0.1', 'localhost') + '/users/fake/onenote/resources/x/$value'
+        self.notebook.contents['page-1-4'] += f'<a href="{outside_url}">link</a>'
+        self.server.notebook = self.notebook
+        resource_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, resource_dir)
+
+        onenote = self._download(batch=True, resource_dir=resource_dir)
+
+        self.assertIn(f'<a href="{outside_url}">link</a>', self.store.get_html('SECTION 1', 'Page 1-4'))
+        html = self.store.get_html('SECTION 1', 'Page 1-3')
+        self.assertNotIn('/onenote/resources/', html)
+        paths = re.findall(r'src="([^"]+)"', html)
+        self.assertEqual(len(paths), 3)
+        with open(paths[2], 'rb') as f:
+            self.assertEqual(f.read(), self.notebook.resources['resource-1-3-1'])
+        self.assertEqual(onenote.resources_downloaded, 21)
+        self.assertEqual(self.server.stats['paths']['resource'], 21)
+        self.assertEqual(len(os.listdir(resource_dir)), 21)
+
+        self.notebook.touch_page('page-0-2', '2021-01-01T10:00:00Z')
+        self.server.reset_stats()
+        onenote = self._download(incremental=True, resource_dir=resource_dir)
+
+        self.assertEqual(onenote.pages_downloaded, 1)
+        self.assertEqual(onenote.resources_cached, 3)
+        self.assertNotIn('resource', self.server.stats['paths'])
+        self.assertNotIn('/onenote/resources/', self.store.get_html('SECTION 0', 'Page 0-2'))
+
+    def test_download_notebook_listing(self):
+        onenote = self._download(notebook_listing=True)
+
+        notes = self.store.notes()
+        self.assertEqual(list(notes['SECTION 0']), [f'Page 0-{number}' for number in range(7)])
+        self.assertEqual(notes['SECTION 2']['Page 2-6'], self.notebook.contents['page-2-6'])
+        self.assertEqual(onenote.pages_downloaded, 21)
+        self.assertNotIn('pages', self.server.stats['paths'])
+        self.assertEqual(self.server.stats['paths']['notebook_pages'], 7)
+
+
+class TestPageStore(unittest.TestCase):
+
+    def test_put_page_and_section(self):
+        store = PageStore(':memory:')
+        store.put_page('Section', 'Title2', 'page2_id', '2020-11-25T16:08:18Z', '<p>Text2</p>', 1)
+        store.put_page('Section', 'Title1', 'page1_id', '2020-11-25T16:08:18Z', '<p>Text1</p>', 0)
+        store.put_page('Section', 'Title3', 'page3_id', '2020-11-25T16:08:18Z', '<p>Text3</p>', 2)
+        store.put_page('Section', 'Title1', 'page1_id', '2020-12-01T13:52:51Z', '<p>New text1</p>', 0)
+        store.put_section('Section', 'section_id', '2020-12-01T13:52:51Z', 0, ['page2_id', 'page1_id'])
+
+        self.assertEqual(store.notes(), {'Section': {'Title2': '<p>Text2</p>', 'Title1': '<p>New text1</p>'}})
+        self.assertEqual(store.get_text('Section', 'Title1'), 'New text1')
+        self.assertEqual(store.get_section_state('Section'), ('section_id', '2020-12-01T13:52:51Z'))
+        self.assertEqual(store.get_page_states('Section'), {
+            'page2_id': '2020-11-25T16:08:18Z', 'page1_id': '2020-12-01T13:52:51Z'
+        })
+        self.assertEqual(store.remove_sections_except(['Other section']), ['Section'])
+        self.assertEqual(store.notes(), {})
+
+    def test_pages_with_the_same_title(self):
+        store = PageStore(':memory:')
+        for position in range(3):
+            store.put_page(
+                'Section', 'Untitled Page', f'page{position}_id', None, f'<p>Text{position}</p>', position,
+                checkpoint=True
+            )
+        self.assertEqual(store.get_checkpoint_pages('Section'), {'page0_id': None, 'page1_id': None, 'page2_id': None})
+        store.put_section('Section', 'section_id', None, 0, ['page2_id', 'page0_id'])
+
+        self.assertEqual(store.titles('Section'), ['Untitled Page', 'Untitled Page'])
+        self.assertEqual(store.get_texts('Section', 'Untitled Page'), ['Text2', 'Text0'])
+        self.assertEqual(store.get_html('Section', 'Untitled Page', 'page0_id'), '<p>Text0</p>')
+        self.assertEqual(store.find_titles('untitled'), [('Section', 'Untitled Page')] * 2)
+        with patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
+            OneNoteOffline(store)._print_note('Section', 'Untitled')
+        self.assertEqual(mock_stdout.getvalue().count('##### TITLE: Untitled Page'), 2)
+        self.assertIn('Text0', mock_stdout.getvalue())
+
+    @patch('onenote.PageStore.get_texts')
+    @patch('onenote.PageStore.get_html')
+    def test_notes_view_reads_pages_on_access(self, get_html_mock, get_texts_mock):
+        store = PageStore(':memory:')
+        store.put_page('Section name1', 'Title11', 'page11_id', None, '<p>Page Text11</p>', 0)
+        store.put_page('Section name1', 'Title12', 'page12_id', None, '<p>Page Text12</p>', 1)
+        store.put_page('Section name2', 'Title21', 'page21_id', None, '<p>Page Text21</p>', 0)
+        store.put_section('Section name2', 'section2_id', None, 0, ['page21_id'])
+        store.put_section('Section name1', 'section1_id', None, 1, ['page11_id', 'page12_id'])
+        get_texts_mock.side_effect = lambda section_name, title: [f'{title} text']
+        onenote_offline = OneNoteOffline(store)
+
+        with patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
+            onenote_offline._print_all_sections()
+            onenote_offline._print_all_titles_in_section('Section name1')
+        self.assertEqual(mock_stdout.getvalue(), 'Section name2\nSection name1\nTitle11\nTitle12\n')
+        self.assertFalse(get_texts_mock.called)
+
+        with patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
+            onenote_offline._print_note('name1', 'Title12')
+        self.assertIn('Title12 text', mock_stdout.getvalue())
+        get_texts_mock.assert_called_once_with('Section name1', 'Title12')
+        self.assertFalse(get_html_mock.called)
+
+    def test_search(self):
+        store = PageStore(':memory:')
+        store.put_page('Linux', 'cron', 'page1_id', None, '<p>Edit crontab with crontab -e</p>', 0)
+        store.put_page('Linux', 'ssh', 'page2_id', None, '<p class="crontab">Copy key with ssh-copy-id</p>', 1)
+        store.put_page('Windows', 'tasks', 'page3_id', None, '<p>Scheduled tasks replace cron</p>', 0)
+        store.put_page('Windows', 'removed', 'page4_id', None, '<p>Old crontab notes</p>', 1)
+        store.put_section('Linux', 'section1_id', None, 0, ['page1_id', 'page2_id'])
+        store.put_section('Windows', 'section2_id', None, 1, ['page3_id'])
+
+        self.assertEqual(
+            store.search('crontab'),
+            [('Linux', 'cron', 'Edit [crontab] with [crontab] -e')]
+        )
+        self.assertEqual(
+            [(section_name, title) for section_name, title, _ in store.search('cron*')],
+            [('Linux', 'cron'), ('Windows', 'tasks')]
+        )
+        self.assertEqual([title for _, title, _ in store.search('"scheduled tasks" cron')], ['tasks'])
+        self.assertEqual([title for _, title, _ in store.search('ssh-copy-id')], ['ssh'])
+        self.assertEqual(store.search('missing'), [])
+
+    def test_find_titles(self):
+        self._check_find_titles(PageStore(':memory:'))
+
+    def test_find_short_titles(self):
+        store = PageStore(':memory:')
+        store.put_page('Section', 'STRASSE', 'page1_id', None, '<p>Text</p>', 0)
+        store.put_page('Section', 'Straße', 'page2_id', None, '<p>Text</p>', 1)
+        store.put_page('Section', 'ÉTÉ', 'page3_id', None, '<p>Text</p>', 2)
+        store.put_page('Section', '100% done', 'page4_id', None, '<p>Text</p>', 3)
+
+        self.assertEqual(store.find_titles('ss'), [('Section', 'STRASSE'), ('Section', 'Straße')])
+        self.assertEqual(store.find_titles('té'), [('Section', 'ÉTÉ')])
+        self.assertEqual(store.find_titles('0%'), [('Section', '100% done')])
+        self.assertEqual(store.find_titles('_'), [])
+
+    def test_find_titles_by_rarest_trigrams(self):
+        store = PageStore(':memory:')
+        for position in range(300):
+            store.put_page('Section', f'Page {position}', f'page{position}_id', None, '<p>Text</p>', position)
+
+        with patch.object(PageStore, 'FUZZY_CANDIDATES', 20):
+            self.assertEqual(store.find_titles('Pgae 271'), [('Section', 'Page 271'), ('Section', 'Page 27')])
+            self.assertEqual(store._rarest_trigrams('pgae 271'), ['271', ' 27'])
+
+    @patch.object(PageStore, 'TITLES_INDEX_SCHEMA', PageStore.TITLES_INDEX_SCHEMA.replace('trigram', 'missing'))
+    def test_find_titles_without_trigram_tokenizer(self):
+        store = PageStore(':memory:')
+        self.assertEqual(store.indexes, ('pages_fts',))
+        self._check_find_titles(store)
+        self.assertEqual(store.remove_sections_except(['Linux']), ['Windows'])
+        self.assertEqual(store.find_titles('cron'), [('Linux', 'Cron'), ('Linux', 'Backup with cron')])
+
+    def _check_find_titles(self, store):
+        store.put_page('Linux', 'Backup with cron', 'page1_id', None, '<p>Text</p>', 0)
+        store.put_page('Linux', 'Cron', 'page2_id', None, '<p>Text</p>', 1)
+        store.put_page('Linux', 'Removed cron notes', 'page3_id', None, '<p>Text</p>', 2)
+        store.put_page('Windows', 'Cron replacement', 'page4_id', None, '<p>Text</p>', 0)
+        store.put_page('Windows', 'Network', 'page5_id', None, '<p>Text</p>', 1)
+        store.put_section('Linux', 'section1_id', None, 0, ['page1_id', 'page2_id'])
+        store.put_section('Windows', 'section2_id', None, 1, ['page4_id', 'page5_id'])
+
+        self.assertEqual(
+            store.find_titles('CRON'),
+            [('Linux', 'Cron'), ('Windows', 'Cron replacement'), ('Linux', 'Backup with cron')]
+        )
+        self.assertEqual(store.find_titles('cron', 'Windows'), [('Windows', 'Cron replacement')])
+        self.assertEqual(
+            store.find_titles('on'),
+            [('Linux', 'Backup with cron'), ('Linux', 'Cron'), ('Windows', 'Cron replacement')]
+        )
+        self.assertEqual(store.find_titles('bakup with'), [('Linux', 'Backup with cron')])
+        self.assertEqual(store.find_titles('networks'), [('Windows', 'Network')])
+        self.assertEqual(store.find_titles('notes'), [])
+
+    def test_find_sections(self):
+        store = PageStore(':memory:')
+        for position, section_name in enumerate(['Linux admin', 'Linux', 'Windows']):
+            store.put_page(section_name, 'Title', f'page{position}_id', None, '<p>Text</p>', 0)
+            store.put_section(section_name, f'section{position}_id', None, position, [f'page{position}_id'])
+
+        self.assertEqual(store.find_sections('linux'), ['Linux', 'Linux admin'])
+        self.assertEqual(store.find_sections('windos'), ['Windows'])
+        self.assertEqual(store.find_sections('mac'), [])
+
+    def test_compress_pages(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'notes.db')
+            store = PageStore(path, compression_level=None)
+            store.put_page('Section', 'Title', 'page_id', None, '<p>Page Text</p>', 0)
+            store.connection.close()
+
+            store = PageStore(path)
+            self.assertEqual(store.connection.execute('SELECT html FROM pages').fetchall(), [('<p>Page Text</p>',)])
+            with patch('sys.stdout', new_callable=io.StringIO):
+                self.assertTrue(store.compress_pages())
+            self.assertFalse(store.compress_pages())
+
+            self.assertEqual(store.connection.execute('SELECT html, text FROM pages').fetchall(), [(None, None)])
+            self.assertEqual(store.get_text('Section', 'Title'), 'Page Text')
+            self.assertEqual(store.get_html('Section', 'Title'), '<p>Page Text</p>')
+            self.assertEqual([title for _, title, _ in store.search('text')], ['Title'])
+            store.connection.close()
+
+    def test_put_page_deduplicates_contents(self):
+        store = PageStore(':memory:')
+        template = '<p>Meeting notes template</p>' * 100
+        store.put_page('Section', 'Title1', 'page1_id', None, template, 0)
+        store.put_page('Section', 'Title2', 'page2_id', None, template, 1)
+        store.put_page('Section', 'Title3', 'page3_id', None, '<p>Other</p>', 2)
+
+        contents = store.connection.execute('SELECT length(data), length(text) FROM contents').fetchall()
+        self.assertEqual(len(contents), 2)
+        self.assertLess(max(contents)[0], len(template) / 10)
+        self.assertLess(max(contents)[1], len(template) / 10)
+        self.assertEqual(store.get_html('Section', 'Title2'), template)
+        self.assertEqual(store.get_text('Section', 'Title2'), 'Meeting notes template' * 100)
+        self.assertEqual([title for _, title, _ in store.search('meeting')], ['Title1', 'Title2'])
+
+        store.put_page('Section', 'Title3', 'page3_id', None, '<p>Edited</p>', 2)
+        self.assertEqual(store.remove_unused_contents(), 1)
+        store.put_section('Section', 'section_id', None, 0, ['page1_id', 'page3_id'])
+        self.assertEqual(store.remove_unused_contents(), 0)
+        self.assertEqual(store.notes(), {'Section': {'Title1': template, 'Title3': '<p>Edited</p>'}})
+
+    def test_put_page_without_compression(self):
+        store = PageStore(':memory:', compression_level=None)
+        store.put_page('Section', 'Title', 'page_id', None, '<p>Page Text</p>', 0)
+
+        self.assertEqual(store.connection.execute('SELECT html FROM pages').fetchall(), [('<p>Page Text</p>',)])
+        self.assertEqual(store.get_html('Section', 'Title'), '<p>Page Text</p>')
+
+    def test_import_shelve(self):
+        with tempfile.TemporaryDirectory() as directory:
+            shelve_path = os.path.join(directory, 'shelve.lib')
+            with shelve.open(shelve_path) as lib:
+                lib['Section name1'] = {'Title11': '<p>Page Text11</p>', 'Title12': '<p>Page Text12</p>'}
+                lib['Section name2'] = {'Title21': '<p>Page Text21</p>'}
+            with shelve.open(os.path.join(directory, 'sync_state.lib')) as sync_state:
+                sync_state['Section name2'] = {
+                    'id': 'section2_id',
+                    'lastModifiedDateTime': '2020-12-01T13:52:51Z',
+                    'pages': {'Title21': {'id': 'page21_id', 'lastModifiedDateTime': '2020-11-25T16:08:18Z'}}
+                }
+
+            with patch('sys.stdout', new_callable=io.StringIO):
+                store = PageStore(os.path.join(directory, 'notes.db'), shelve_path)
+
+            self.assertEqual(store.notes(), {
+                'Section name1': {'Title11': '<p>Page Text11</p>', 'Title12': '<p>Page Text12</p>'},
+                'Section name2': {'Title21': '<p>Page Text21</p>'},
+            })
+            self.assertEqual(store.get_section_state('Section name1'), (None, None))
+            self.assertEqual(store.get_text('Section name1', 'Title12'), 'Page Text12')
+            self.assertEqual(store.get_section_state('Section name2'), ('section2_id', '2020-12-01T13:52:51Z'))
+            self.assertEqual(store.get_page_states('Section name2'), {'page21_id': '2020-11-25T16:08:18Z'})
+            self.assertEqual(store.get_page_states('Section name1'), {'shelve:Title11': None, 'shelve:Title12': None})
+            store.connection.close()
 
 
 class TestOneNoteOffline(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
+        store = PageStore(':memory:')
         with shelve.open('shelve_fixture.lib') as lib:
-            notes_fixture = dict(lib)
-        cls.onenote_offline = OneNoteOffline()
-        cls.onenote_offline.notes = notes_fixture
+            for section_position, (section_name, section_notes) in enumerate(lib.items()):
+                for position, (title, html) in enumerate(section_notes.items()):
+                    store.put_page(section_name, title, f'{title} id', None, html, position)
+                page_ids = [f'{title} id' for title in section_notes]
+                store.put_section(section_name, f'{section_name} id', None, section_position, page_ids)
+        cls.onenote_offline = OneNoteOffline(store)
 
     @patch('sys.stdout', new_callable=io.StringIO)
     def test_display_titles_with_keyword_in_page(self, mock_stdout):
         self.onenote_offline._display_titles_with_keyword_in_page('Page Text11')
         self.assertIn('##### SECTION: Section name1 #####', mock_stdout.getvalue())
+        self.assertIn('[Page] [Text11]', mock_stdout.getvalue())
         self.assertIn('TITLE: Title11', mock_stdout.getvalue())
         self.assertNotIn('##### SECTION: Section name2 #####', mock_stdout.getvalue())
         self.assertNotIn('TITLE: Title12', mock_stdout.getvalue())
@@ -154,6 +865,22 @@ class TestOneNoteOffline(unittest.TestCase):
         self.assertNotIn('Page Text21', mock_stdout.getvalue())
         self.assertNotIn('Page Text22', mock_stdout.getvalue())
 
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_print_note_exact_section_name(self, mock_stdout):
+        store = PageStore(':memory:')
+        for position, section_name in enumerate(['S1', 'S10', 'S11']):
+            store.put_page(section_name, 'Title', f'page{position}_id', None, f'<p>Text of {section_name}</p>', 0)
+            store.put_section(section_name, f'section{position}_id', None, position, [f'page{position}_id'])
+        onenote_offline = OneNoteOffline(store)
+
+        onenote_offline._print_note('s1', 'Title')
+        self.assertIn('##### SECTION: S1 #####', mock_stdout.getvalue())
+        self.assertIn('Text of S1\n', mock_stdout.getvalue())
+        self.assertNotIn('S10', mock_stdout.getvalue())
+
+        onenote_offline._print_note('S', 'Title')
+        self.assertIn("matches more than one section: ['S1', 'S10', 'S11']", mock_stdout.getvalue())
+
     @patch('sys.stdout', new_callable=io.StringIO)
     def test_print_titles_with_keyword(self, mock_stdout):
         self.onenote_offline._print_titles_with_keyword('Title1')
@@ -162,6 +889,113 @@ class TestOneNoteOffline(unittest.TestCase):
         self.assertNotIn('Title2', mock_stdout.getvalue())
         self.assertNotIn('Section name2', mock_stdout.getvalue())
 
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_print_titles_with_keyword_typo(self, mock_stdout):
+        self.onenote_offline._print_titles_with_keyword('Titel21')
+        self.assertIn('TITLE: Title21', mock_stdout.getvalue())
+        self.assertIn('Page Text21', mock_stdout.getvalue())
+
+    def test_query_stats(self):
+        onenote_offline = OneNoteOffline(self.onenote_offline.store)
+        onenote_offline.query(['-t', 'Title21'])
+        onenote_offline.query(['-f', 'Text12'])
+
+        phases = onenote_offline.stats()['phases']
+        self.assertEqual(phases['query']['count'], 2)
+        self.assertEqual(phases['title lookup']['count'], 1)
+        self.assertEqual(phases['page read']['count'], 1)
+        self.assertEqual(phases['search']['count'], 1)
+
+    def test_query(self):
+        output = self.onenote_offline.query(['-s', 'Section name1', '-t', 'Title11'])
+        self.assertIn('##### TITLE: Title11', output)
+        self.assertIn('Page Text11', output)
+        self.assertIn('usage:', self.onenote_offline.query(['--missing-option']))
+        self.assertIn('--workers/-w: must be greater than 0', self.onenote_offline.query(['-w', '0']))
+        self.assertIn('--rate: must be greater than 0', self.onenote_offline.query(['--rate', '0']))
+
+    @patch('builtins.input')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_interactive(self, mock_stdout, input_mock):
+        input_mock.side_effect = ['--allsections', '', '-f "Page Text21"', 'quit', '-t Title11']
+        self.onenote_offline.interactive()
+        self.assertIn('Section name1\n', mock_stdout.getvalue())
+        self.assertIn('Section name2\n', mock_stdout.getvalue())
+        self.assertIn('TITLE: Title21', mock_stdout.getvalue())
+        self.assertNotIn('Title11', mock_stdout.getvalue())
+        self.assertEqual(input_mock.call_count, 4)
+
+    def test_query_error_does_not_end_session(self):
+        with tempfile.TemporaryDirectory() as directory:
+            socket_path = os.path.join(directory, 'onenote.sock')
+            outputs = []
+            with self.onenote_offline.make_query_server(socket_path) as server:
+                def send_queries():
+                    outputs.append(query_server(socket_path, ['-s', 'nosuch', '--alltitles']))
+                    outputs.append(query_server(socket_path, ['-t', 'Title12']))
+                client = threading.Thread(target=send_queries)
+                client.start()
+                server.handle_request()
+                server.handle_request()
+                client.join()
+        self.assertEqual(outputs[0], 'Provided section name not found.\n')
+        self.assertIn('TITLE: Title12', outputs[1])
+
+    def test_query_server(self):
+        with tempfile.TemporaryDirectory() as directory:
+            socket_path = os.path.join(directory, 'onenote.sock')
+            outputs = []
+            with self.onenote_offline.make_query_server(socket_path) as server:
+                client = threading.Thread(
+                    target=lambda: outputs.append(query_server(socket_path, ['--connect', socket_path, '-t', 'Title12']))
+                )
+                client.start()
+                server.handle_request()
+                client.join()
+        self.assertIn('TITLE: Title12', outputs[0])
+        self.assertIn('Page Text12', outputs[0])
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_export(self, mock_stdout):
+        store = PageStore(':memory:')
+        store.put_page('Section/1', 'Title11', 'page11_id', None,
+                       '<html><body><h1>Heading</h1><p>Text <b>bold</b> <a href="https://x.org">link</a></p>'
+                       '<ul><li>One</li><li>Two</li></ul><img src="resources/ab/abcd.png" alt="image"/>'
+                       '</body></html>', 0)
+        store.put_page('Section/1', 'Title12', 'page12_id', None, '<p>Page Text12</p>', 1)
+        store.put_page('Section2', 'Title21', 'page21_id', None, '<p>Page Text21</p>', 0)
+        store.put_section('Section/1', 'section1_id', None, 0, ['page11_id', 'page12_id'])
+        store.put_section('Section2', 'section2_id', None, 1, ['page21_id'])
+        onenote_offline = OneNoteOffline(store)
+
+        with tempfile.TemporaryDirectory() as directory:
+            export_directory = os.path.join(directory, 'export')
+            counts = onenote_offline.export(export_directory, 'md', workers=2)
+            self.assertEqual(counts, {'written': 3, 'unchanged': 0, 'removed': 0})
+            with open(os.path.join(export_directory, 'Section_1', 'Title11.md')) as f:
+                markdown = f.read()
+            self.assertIn('# Title11\n\n# Heading\n\nText **bold** [link](https://x.org)', markdown)
+            self.assertIn('- One\n- Two', markdown)
+            image_path = os.path.relpath(os.path.abspath('resources/ab/abcd.png'),
+                                         os.path.join(export_directory, 'Section_1'))
+            self.assertIn(f'![image]({image_path})', markdown)
+            self.assertEqual(onenote_offline.export(export_directory, 'md', workers=2),
+                             {'written': 0, 'unchanged': 3, 'removed': 0})
+
+            store.put_page('Section/1', 'Title12', 'page12_id', '2020-12-01T13:52:51Z', '<p>New text12</p>', 1)
+            store.remove_sections_except(['Section/1'])
+            self.assertEqual(onenote_offline.export(export_directory, 'md', workers=2),
+                             {'written': 1, 'unchanged': 1, 'removed': 1})
+            with open(os.path.join(export_directory, 'Section_1', 'Title12.md')) as f:
+                self.assertIn('New text12', f.read())
+            self.assertFalse(os.path.exists(os.path.join(export_directory, 'Section2')))
+
+            onenote_offline.export(export_directory, 'txt', workers=2)
+            with open(os.path.join(export_directory, 'Section_1', 'Title12.txt')) as f:
+                self.assertEqual(f.read(), 'New text12')
+            self.assertFalse(os.path.exists(os.path.join(export_directory, 'Section_1', 'Title12.md')))
+        self.assertEqual(onenote_offline.stats()['phases']['export']['count'], 4)
+
     @patch('onenote.OneNoteOffline._print_titles_with_keyword')
     @patch('onenote.OneNoteOffline._print_note')
     @patch('onenote.OneNoteOffline._print_all_titles_in_section')
@@ -209,5 +1043,74 @@ class TestOneNoteOffline(unittest.TestCase):
         args_mock.title = False
 
 
+class TestStartup(unittest.TestCase):
+    '''Guards cold start of offline queries, measured by running onenote.py
+    with python -X importtime: modules used only by download must not be
+    imported and imports must fit in time budget
+    '''
+    DOWNLOAD_MODULES = ['requests', 'msal', 'bs4', 'pyperclip', 'dateutil.parser', 'concurrent.futures.process']
+    IMPORT_BUDGET_MS = 120
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        store = PageStore(os.path.join(cls.directory.name, 'notes.db'))
+        store.put_page('Linux', 'Cron jobs', 'page_id', None, '<p>crontab -e</p>', 0)
+        store.put_section('Linux', 'section_id', None, 0, ['page_id'])
+        store.connection.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def _run_query(self, *options):
+        '''Returns (output, {module: cumulative import microseconds}, import
+        microseconds of modules imported by onenote.py)
+        '''
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, 'onenote.py')
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', script, *options],
+            cwd=self.directory.name, capture_output=True, text=True, check=True
+        )
+        imports = {}
+        after_startup = False
+        script_import_us = 0
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            _, cumulative_us, name = line[len('import time:'):].split('|')
+            if not cumulative_us.strip().isdigit():
+                continue
+            imports[name.strip()] = int(cumulative_us)
+            if after_startup and name.startswith(' ') and not name.startswith('  '):
+                script_import_us += int(cumulative_us)
+            after_startup = after_startup or name.strip() == 'site'
+        return result.stdout, imports, script_import_us
+
+    def test_allsections_startup(self):
+        output, imports, script_import_us = self._run_query('--allsections')
+
+        self.assertEqual(output, 'Linux\n')
+        self.assertEqual([module for module in self.DOWNLOAD_MODULES if module in imports], [])
+        self.assertLess(script_import_us / 1000, self.IMPORT_BUDGET_MS)
+
+    def test_stats_and_profile(self):
+        profile_path = os.path.join(self.directory.name, 'query.prof')
+        output, _, _ = self._run_query('-t', 'cron', '--stats', '--profile', profile_path)
+
+        stats = json.loads(output[output.index('{'):])
+        self.assertEqual(stats['phases']['query']['count'], 1)
+        self.assertIn('open store', stats['phases'])
+        self.assertIn('page read', stats['phases'])
+        self.assertGreater(pstats.Stats(profile_path).total_calls, 0)
+
+    def test_section_title_startup(self):
+        output, imports, script_import_us = self._run_query('-s', 'linux', '-t', 'cron')
+
+        self.assertIn('crontab -e', output)
+        self.assertEqual([module for module in self.DOWNLOAD_MODULES if module in imports], [])
+        self.assertLess(script_import_us / 1000, self.IMPORT_BUDGET_MS)
+
+
 if __name__ == '__main__':
     unittest.main()